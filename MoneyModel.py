@@ -1,20 +1,31 @@
 from tqdm import tqdm
+import gzip
+import pickle
 from collections import defaultdict
-from mesa import Model, Agent
+from itertools import accumulate
+from mesa import Model
 from entity import Entity, Miner, Exchange, Merchant
 # from typing import Dict, ClassVar
 from mesa.time import RandomActivation
-import matplotlib.pyplot as plt
 import random
+import ids
 from blockchain import Blockchain
+from blocktree import BlockTree
 from block import Block
-from transaction import Transaction
-from typing import List
-import json
+from mempool import Mempool, EVICTION_POLICIES
+from population import BatchedActivation
+from events import EventActivation
+from matching import MerchantIndex
+from network import PeerNetwork
+from instrumentation import Instrumentation
+from recorder import SimulationRecorder
+from typing import List, Dict, Tuple, Optional, Type, Iterable
 
 RANDOM_SEED = 123
 random.seed(RANDOM_SEED)
 
+CHECKPOINT_VERSION = 1
+
 
 class MoneyModel(Model):
     num_agents: int
@@ -22,30 +33,84 @@ class MoneyModel(Model):
     habits_range: range
     MAX_HABITS: int
     MINER_PERCENTAGE: float
+    block_tree: BlockTree
     blockchain: Blockchain
-    pending_transactions: List[Transaction]
+    mempool: Mempool
     candidate_blocks: List[Blockchain]
+    roles: Dict[Type[Entity], List[Entity]]
 
     def __init__(self, N: int, habits_range: range = range(1, 10), MAX_HABITS: int = 10,
-                 MINER_PERCENTAGE = 0.1, SELLER_PERCENTAGE = 0.2, EXCHANGE_PERCENTAGE = 0.02):
+                 MINER_PERCENTAGE = 0.1, SELLER_PERCENTAGE = 0.2, EXCHANGE_PERCENTAGE = 0.02, seed=None, engine: str = 'agents'):
+        """
+        :param seed: The seed of the random number generator of the model. It is used by Model.__new__
+        :param engine: 'agents' lets every agent make its own draws, 'vectorized' draws the decisions of all agents
+        at once with population.BatchedActivation, which scales to much larger populations, and 'events' only wakes
+        agents at random times drawn from their rates with events.EventActivation
+        """
         super().__init__()
         self.MAX_HABITS = MAX_HABITS
         self.habits_range = habits_range
         self.num_agents = N
-        self.schedule = RandomActivation(self)
+        if engine == 'agents':
+            self.schedule = RandomActivation(self)
+        elif engine == 'vectorized':
+            self.schedule = BatchedActivation(self)
+        elif engine == 'events':
+            self.schedule = EventActivation(self)
+        else:
+            raise ValueError('Unknown engine: %s' % engine)
         self.TRANSACTIONS_PER_BLOCK = 500
-        self.pending_transactions = []
-        self.transaction_age = defaultdict(int)
         self.candidate_blocks = []
         self.MINER_PERCENTAGE = MINER_PERCENTAGE
         self.SELLER_PERCENTAGE = SELLER_PERCENTAGE
         self.EXCHANGE_PERCENTAGE = EXCHANGE_PERCENTAGE
         self.BUYER_PERCENTAGE = 1-MINER_PERCENTAGE-SELLER_PERCENTAGE-EXCHANGE_PERCENTAGE
-        self.blockchain = Blockchain(Block('0', []))
+        # Identifiers of blocks, transactions and wallets follow the seed of the model
+        ids.seed(self._seed)
+        # Every agent follows a tip of the same tree of blocks
+        genesis = Block('0', [])
+        self.block_tree = BlockTree(genesis)
+        # Number of chain tips for which the unspent outputs and balances are cached. The cache of the tree keeps it, so that it can
+        # be changed after creating the model
+        self.STATE_CACHE_SIZE = 16
+        self.blockchain = Blockchain(genesis, self.block_tree)
+        # Hits, misses and evictions of the state cache in each step
+        self.cache_stats = []
+        # Expired, evicted and pending transactions in each step
+        self.mempool_stats = []
+        # Timing of the phases of steps, see instrument
+        self.instrumentation = None
         self.AVG_TRANSACTION = 0.5
         self.WEALTH_SD = 0.2
         self.BLOCK_MINING_REWARD = 50
+        # The mempool keeps TRANSACTION_EXPIRY and MEMPOOL_SIZE, so that they can be changed after creating the model
+        self.mempool = Mempool(3)
         self.TRANSACTION_EXPIRY = 3
+        # The coin selection strategy of wallets, see coinselection.STRATEGIES. 'approximate' runs the same search in
+        # batches with NumPy, which is much faster for wallets with many outputs
+        self.COIN_SELECTION = 'knapsack'
+        # Maximum number of pending transactions. None for no limit
+        self.MEMPOOL_SIZE = None
+        # What happens to a transaction made when the mempool is full, see MEMPOOL_EVICTION
+        self.MEMPOOL_EVICTION = 'oldest'
+        # Agents by their role, in the order they were added
+        self.roles = defaultdict(list)
+        self._habit_merchants = None
+        self._exchange_weights = None
+        # How buyers pick a merchant. 'habit' picks one habit of the buyer and a merchant with that habit, 'embedding'
+        # weighs the merchants most similar to the habits of the buyer
+        self.MERCHANT_MATCHING = 'habit'
+        # The number of most similar merchants a buyer picks from
+        self.MATCHING_TOP_K = 20
+        self._merchant_index = None
+        # With None every agent samples the chain of any other agent. Otherwise agents only see the chains of their peers
+        # in a graph of the given topology, see network.make_graph
+        self.NETWORK_TOPOLOGY = None
+        self.PEERS = 8
+        # Generated at the first step, so that the settings can be changed after creating the model
+        self.network = None
+        # The number of times per step a merchant catches up with the chain, with the 'events' engine
+        self.MERCHANT_SYNC_RATE = 0.1
 
         agent_classes = random.choices(['miner', 'buyer', 'seller', 'exchange'],
                                        [MINER_PERCENTAGE, self.BUYER_PERCENTAGE, SELLER_PERCENTAGE, EXCHANGE_PERCENTAGE],
@@ -71,22 +136,189 @@ class MoneyModel(Model):
                 # TODO add exchange agent class
                 a = Exchange(i, self, self.random.random())
 
-            self.schedule.add(a)
+            self.add_agent(a)
+
+    @property
+    def STATE_CACHE_SIZE(self) -> int:
+        return self.block_tree.states.maxsize
+
+    @STATE_CACHE_SIZE.setter
+    def STATE_CACHE_SIZE(self, maxsize: int):
+        self.block_tree.states.resize(maxsize)
+
+    @property
+    def TRANSACTION_EXPIRY(self) -> int:
+        """
+        The number of steps a transaction stays pending after the step it was made in
+        """
+        return self.mempool.expiry
+
+    @TRANSACTION_EXPIRY.setter
+    def TRANSACTION_EXPIRY(self, expiry: int):
+        self.mempool.expiry = expiry
+
+    @property
+    def MEMPOOL_SIZE(self) -> Optional[int]:
+        """
+        The maximum number of pending transactions. None for no limit
+        """
+        return self.mempool.max_size
+
+    @MEMPOOL_SIZE.setter
+    def MEMPOOL_SIZE(self, max_size: Optional[int]):
+        self.mempool.max_size = max_size
+
+    @property
+    def MEMPOOL_EVICTION(self) -> str:
+        """
+        'oldest' evicts the oldest pending transaction to make room for a new one, 'reject' drops the new one
+        """
+        return self.mempool.eviction
+
+    @MEMPOOL_EVICTION.setter
+    def MEMPOOL_EVICTION(self, eviction: str):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError('Unknown eviction policy: %s' % eviction)
+        self.mempool.eviction = eviction
+
+    def add_agent(self, agent: Entity):
+        """
+        Add an agent to the schedule and to the registry of its roles
+        """
+        self.schedule.add(agent)
+        for role in (Entity, Miner, Merchant, Exchange):
+            if isinstance(agent, role):
+                self.roles[role].append(agent)
+        # The sampling tables are rebuilt when they are next used
+        self._habit_merchants = None
+        self._exchange_weights = None
+        if isinstance(agent, Merchant):
+            self._merchant_index = None
+        if self.network is not None:
+            self.network.add(agent, self.random)
+
+    def get_agents(self, role: Type[Entity]) -> List[Entity]:
+        return self.roles[role]
+
+    def habit_merchants(self, habit: int) -> Tuple[List[Merchant], List[float]]:
+        """
+        :param habit: The index of a habit
+        :return: The merchants with the habit and the cumulative sums of their popularity
+        """
+        if self._habit_merchants is None:
+            self._habit_merchants = defaultdict(lambda: ([], []))
+            for merchant in self.roles[Merchant]:
+                for index in merchant.get_habit_indices():
+                    merchants, cum_weights = self._habit_merchants[index]
+                    merchants.append(merchant)
+                    cum_weights.append((cum_weights[-1] if cum_weights else 0) + merchant.popularity)
+        return self._habit_merchants.get(habit, ([], []))
+
+    def matched_merchants(self, habits: List[bool]) -> Tuple[List[Merchant], List[float]]:
+        """
+        :param habits: The habits of a buyer
+        :return: The merchants most similar to the habits and the cumulative sums of their weights
+        """
+        if self._merchant_index is None:
+            self._merchant_index = MerchantIndex(self.roles[Merchant], self.MATCHING_TOP_K, self.MAX_HABITS)
+            self._merchant_index.precompute([x.habits for x in self.roles[Entity] if x.habits])
+        return self._merchant_index.candidates(habits)
+
+    def choose_exchange(self) -> Optional[Exchange]:
+        """
+        Select an exchange based on popularity
+        """
+        exchanges = self.roles[Exchange]
+        if len(exchanges) == 0:
+            return None
+        if self._exchange_weights is None:
+            self._exchange_weights = list(accumulate([x.popularity for x in exchanges]))
+        return self.random.choices(exchanges, cum_weights=self._exchange_weights)[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Rebuilt from the role registry when they are next used
+        state['_habit_merchants'] = None
+        state['_merchant_index'] = None
+        state['instrumentation'] = None
+        return state
+
+    def save_checkpoint(self, path: str):
+        """
+        Save the model between steps. The agents, the tree of blocks, the mempool and the state of every random number
+        generator are saved, so that a model loaded from the checkpoint continues exactly like this one
+        :param path: The file to write the checkpoint to
+        """
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'model': self,
+            'random_state': random.getstate(),
+            'ids_state': ids.getstate()
+        }
+        with gzip.open(path, 'wb') as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load_checkpoint(cls, path: str, seed=None) -> 'MoneyModel':
+        """
+        Load a model saved with save_checkpoint. This replaces the state of the random module and of the identifiers
+        :param path: The checkpoint file
+        :param seed: Reseed the model and the random module, to branch a different run off the checkpoint. The
+        model continues exactly like the saved one if it is None
+        """
+        with gzip.open(path, 'rb') as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            raise CheckpointVersionException(path, checkpoint.get('version'))
+        model = checkpoint['model']
+        random.setstate(checkpoint['random_state'])
+        # Identifiers are not reseeded, they only have to stay unique within the model
+        ids.setstate(checkpoint['ids_state'])
+        if seed is not None:
+            model.reset_randomizer(seed)
+            random.seed(seed)
+        return model
+
+    def instrument(self, profile_steps: Iterable[int] = (), profiler: str = 'cprofile',
+                   profile_dir: str = None) -> Instrumentation:
+        """
+        Start timing the phases of every step. See instrumentation.Instrumentation for the parameters
+        """
+        if self.instrumentation is not None:
+            self.instrumentation.stop()
+        self.instrumentation = Instrumentation(profile_steps, profiler, profile_dir)
+        self.instrumentation.start()
+        return self.instrumentation
+
+    def uninstrument(self):
+        if self.instrumentation is not None:
+            self.instrumentation.stop()
+            self.instrumentation = None
 
     def step(self):
+        if self.instrumentation is not None:
+            self.instrumentation.step(self, self._step)
+        else:
+            self._step()
+
+    def _step(self):
+        if self.NETWORK_TOPOLOGY is not None:
+            if self.network is None:
+                self.network = PeerNetwork(self.schedule.agents, self.NETWORK_TOPOLOGY, self.PEERS, self.random)
+            self.network.announce()
         self.schedule.step()
-        # for pending transactions. increase transaction age
-        for tr in self.pending_transactions:
-            self.transaction_age[tr.id] += 1
         # remove transactions which are old
-        t_pending_transactions = []
-        for tr in self.pending_transactions:
-            if self.transaction_age[tr.id] <= self.TRANSACTION_EXPIRY:
-                t_pending_transactions.append(tr)
-        self.pending_transactions = t_pending_transactions
+        expired = self.mempool.expire()
+        self.cache_stats.append(self.block_tree.states.stats(reset=True))
+        self.mempool_stats.append({'expired': expired, 'evicted': self.mempool.evicted, 'pending': len(self.mempool)})
         # Select Miners and Register pending transactions
 
 
+class CheckpointVersionException(Exception):
+    def __init__(self, path: str, version):
+        super().__init__('Checkpoint %s has version %s, expected %d' % (path, version, CHECKPOINT_VERSION))
+
+
 # class MoneyAgent(Agent):
 #     def __init__(self, uid: int, model: MoneyModel):
 #         super().__init__(uid, model)
@@ -114,14 +346,14 @@ if __name__ == "__main__":
     print("Exchanges: %d" % len(exchanges))
     print("Miners: %d" % len(miners))
 
-    simulation = []
-    for i in tqdm(range(100)):
-        m_model.step()
-        step_data = [x.to_dict() for x in m_model.schedule.agents]
-        simulation.append(step_data)
+    # Each step is written as soon as it completes
+    with SimulationRecorder('simulation.jsonl', keyframe_interval=20) as recorder:
+        for i in tqdm(range(100)):
+            m_model.step()
+            recorder.record(m_model)
 
-    with open('simulation.json', 'w') as sim_file:
-        json.dump(simulation, sim_file)
+    print("State cache: %d hits, %d misses, %d evictions" % tuple(
+        sum([x[k] for x in m_model.cache_stats]) for k in ('hits', 'misses', 'evictions')))
 
     # agent_wealth = [a.wealth for a in m_model.schedule.agents]
     # plt.hist(agent_wealth)
@@ -0,0 +1,409 @@
+"""
+Analytics of recorded simulations. ChainAnalytics follows the chain most agents are on from step to step, applying the
+blocks which are new since the previous step and undoing the blocks which left the chain when it switched to another
+fork, so that analysing a run takes time linear in the number of blocks instead of re-reading every chain from
+genesis.
+
+RunIndex indexes a whole run in one pass over its steps into columnar tables of agents, addresses, blocks,
+transactions, flows between agents and wealth over time, which answer queries without reading the run again and are
+saved to and loaded from .npz files:
+
+    index = RunIndex.build(open_simulation('simulation.jsonl'))
+    index.top_flows(10)
+    index.save('simulation.npz')
+    index = RunIndex.load('simulation.npz')
+"""
+import argparse
+from collections import defaultdict
+from typing import DefaultDict, Dict, Iterable, List, Tuple
+import numpy as np
+from loader import open_simulation
+
+
+def master_chain(step: List[Dict]) -> Dict:
+    """
+    :param step: The agents of a step as written by Entity.to_dict
+    :return: The chain followed by most agents
+    """
+    chains = {}
+    chain_counts = defaultdict(int)
+    for agent in step:
+        chain = agent['blockchain']
+        chains[chain['hash']] = chain
+        chain_counts[chain['hash']] += 1
+    frequent_chains = sorted(chain_counts.items(), key=lambda x: x[1])
+    return chains[frequent_chains[-1][0]]
+
+
+class ChainAnalytics:
+    """
+    The balances of the wallets and the numbers of transactions between agents on a chain. A transaction counts once
+    for every pair of a different agent sending and an agent receiving in it, as in visualize.get_user_user_transactions.
+    """
+    blocks: List[Dict]
+    balances: DefaultDict[str, float]
+    transactions: DefaultDict[Tuple[int, int], int]
+    # The blocks applied and undone by the last update, in the order they were
+    applied: List[Dict]
+    undone: List[Dict]
+
+    def __init__(self):
+        self.blocks = []
+        self.applied = []
+        self.undone = []
+        self.balances = defaultdict(float)
+        self.transactions = defaultdict(int)
+        # The pairs of agents counted for every block, to undo them without the wallets of the step they were counted in
+        self._block_pairs: Dict[str, List[Tuple[int, int]]] = {}
+
+    def update(self, blocks: List[Dict], wallet_agent: Dict[str, int]) \
+            -> Tuple[DefaultDict[str, float], DefaultDict[Tuple[int, int], int]]:
+        """
+        Move to another chain
+        :param blocks: The blocks of the chain from genesis, as written by Block.to_dict
+        :param wallet_agent: The agent of every wallet
+        :return: The balances and the transactions between agents on the chain. They are updated by later calls
+        """
+        # Blocks at the same position with the same hash are the common part of both chains
+        common = min(len(self.blocks), len(blocks))
+        while common > 0 and self.blocks[common - 1]['hash'] != blocks[common - 1]['hash']:
+            common -= 1
+        self.undone = self.blocks[common:][::-1]
+        self.applied = blocks[common:]
+        for block in self.undone:
+            self._undo(block)
+        for block in self.applied:
+            self._apply(block, wallet_agent)
+        self.blocks = blocks
+        return self.balances, self.transactions
+
+    def _apply(self, block: Dict, wallet_agent: Dict[str, int]):
+        pairs = []
+        for transaction in block['transactions']:
+            for i in transaction['inputs']:
+                self.balances[i['address']] -= i['amount']
+            for o in transaction['outputs']:
+                self.balances[o['address']] += o['amount']
+
+            # Addresses whose wallet has not been seen yet belong to no agent, -1
+            input_users = set([wallet_agent.get(x['address'], -1) for x in transaction['inputs']
+                               if x['address'] != 'reward'])
+            output_users = set([wallet_agent.get(x['address'], -1) for x in transaction['outputs']])
+            pairs.extend([(i, o) for i in input_users for o in output_users if i != o and i >= 0 and o >= 0])
+        for pair in pairs:
+            self.transactions[pair] += 1
+        self._block_pairs[block['hash']] = pairs
+
+    def _undo(self, block: Dict):
+        for transaction in reversed(block['transactions']):
+            for o in transaction['outputs']:
+                self.balances[o['address']] -= o['amount']
+            for i in transaction['inputs']:
+                self.balances[i['address']] += i['amount']
+        for pair in self._block_pairs.pop(block['hash']):
+            self.transactions[pair] -= 1
+            if self.transactions[pair] == 0:
+                del self.transactions[pair]
+
+
+class RunIndex:
+    """
+    Columnar tables of a run, built once from its steps. Agents are referred to by id, and addresses, blocks and
+    transactions by their row in their table:
+
+    - agent_id, agent_type: every agent of the run
+    - address, address_agent: every wallet and the agent owning it, -1 for addresses no agent owns
+    - block_hash, block_height, block_first_seen, block_confirmed: every block on the chain of any agent, the first step
+      it was on a chain, and the first step it was on the master chain with at least confirmations blocks from its tip,
+      or -1
+    - tx_hash, inclusion_tx, inclusion_block: every transaction and the blocks including it, which are several blocks
+      when the transaction was mined on more than one fork
+    - io_inclusion, io_address, io_amount: the inputs, with negative amounts, and outputs of every inclusion
+    - flow_step, flow_src, flow_dst, flow_amount, flow_count: the payments between agents of the blocks the master chain
+      gained in every step, with negative amounts and counts for the blocks it lost to another fork
+    - master_length, wealth: the length of the master chain and the wealth of every agent, in the order of agent_id,
+      at every step
+    """
+    TABLES = ['agent_id', 'agent_type', 'address', 'address_agent', 'block_hash', 'block_height', 'block_first_seen',
+              'block_confirmed', 'tx_hash', 'inclusion_tx', 'inclusion_block', 'io_inclusion', 'io_address',
+              'io_amount', 'flow_step', 'flow_src', 'flow_dst', 'flow_amount', 'flow_count', 'master_length', 'wealth',
+              'confirmations']
+
+    def __init__(self, **tables: np.ndarray):
+        for name in self.TABLES:
+            setattr(self, name, tables[name])
+        # Indexes of the queries, built once: the rows of addresses and transactions by hash, and the rows of the
+        # addresses of every agent, of the inputs and outputs of every address and of the inclusions of every
+        # transaction, as an order of the rows grouped by key with the start of every group
+        self._address_rows = {x: i for i, x in enumerate(self.address.tolist())}
+        self._tx_rows = {x: i for i, x in enumerate(self.tx_hash.tolist())}
+        self._agent_order = np.argsort(self.address_agent, kind='stable')
+        self._agent_keys = self.address_agent[self._agent_order]
+        self._io_order, self._io_starts = _groups(self.io_address, len(self.address))
+        self._inclusion_order, self._inclusion_starts = _groups(self.inclusion_tx, len(self.tx_hash))
+
+    @classmethod
+    def build(cls, steps: Iterable[List[Dict]], confirmations: int = 1) -> 'RunIndex':
+        """
+        :param steps: The agents of every step as written by Entity.to_dict, such as a reader of loader.open_simulation
+        :param confirmations: The number of blocks from the tip, the block included, at which a block is confirmed
+        """
+        builder = _RunIndexBuilder(confirmations)
+        for step in steps:
+            builder.add(step)
+        return cls(**builder.tables())
+
+    @classmethod
+    def load(cls, path: str) -> 'RunIndex':
+        with np.load(path) as tables:
+            return cls(**{x: tables[x] for x in cls.TABLES})
+
+    def save(self, path: str):
+        np.savez_compressed(path, **{x: getattr(self, x) for x in self.TABLES})
+
+    def agent_addresses(self, agent: int) -> List[str]:
+        start, end = np.searchsorted(self._agent_keys, [agent, agent + 1])
+        return self.address[self._agent_order[start:end]].tolist()
+
+    def address_transactions(self, address: str) -> List[str]:
+        """
+        :return: The transactions with an input or output at the address, in the order they were first seen
+        """
+        row = self._address_rows.get(address)
+        if row is None:
+            return []
+        ios = self._io_order[self._io_starts[row]:self._io_starts[row + 1]]
+        return self.tx_hash[np.unique(self.inclusion_tx[self.io_inclusion[ios]])].tolist()
+
+    def transaction_heights(self, txid: str) -> List[int]:
+        """
+        :return: The heights of the blocks including the transaction
+        """
+        tx = self._tx_rows.get(txid)
+        if tx is None:
+            return []
+        inclusions = self._inclusion_order[self._inclusion_starts[tx]:self._inclusion_starts[tx + 1]]
+        return self.block_height[self.inclusion_block[inclusions]].tolist()
+
+    def flow_graph(self, step: int) -> Dict[Tuple[int, int], Tuple[float, int]]:
+        """
+        :return: The amount and number of payments between agents the master chain gained in the step
+        """
+        return self._flows(self.flow_step == step)
+
+    def top_flows(self, k: int = 10, step: int = None, by: str = 'amount') -> List[Tuple[int, int, float, int]]:
+        """
+        :param step: The step of the master chain, the last step if None
+        :param by: 'amount' or 'count'
+        :return: The source, destination, amount and number of the k largest flows between agents on the master chain
+        """
+        if by not in ('amount', 'count'):
+            raise ValueError('Unknown flow order: %s' % by)
+        if step is None:
+            step = len(self.master_length) - 1
+        flows = self._flows(self.flow_step <= step)
+        key = (lambda x: x[1][0]) if by == 'amount' else (lambda x: x[1][1])
+        return [(src, dst, amount, count) for (src, dst), (amount, count) in sorted(flows.items(), key=key)[::-1][:k]]
+
+    def wealth_over_time(self, agent: int = None) -> np.ndarray:
+        """
+        :return: The wealth of the agent at every step, or of every agent in the order of agent_id if None
+        """
+        if agent is None:
+            return self.wealth
+        return self.wealth[:, np.flatnonzero(self.agent_id == agent)[0]]
+
+    def confirmation_latency(self) -> np.ndarray:
+        """
+        :return: For every transaction the steps from when it was first on a chain to when it was first confirmed, or
+        -1 if it never was
+        """
+        never = np.iinfo(np.int64).max
+        first_seen = np.full(len(self.tx_hash), never)
+        np.minimum.at(first_seen, self.inclusion_tx, self.block_first_seen[self.inclusion_block])
+        confirmed_at = self.block_confirmed[self.inclusion_block]
+        confirmed = np.full(len(self.tx_hash), never)
+        np.minimum.at(confirmed, self.inclusion_tx, np.where(confirmed_at >= 0, confirmed_at, never))
+        return np.where(confirmed < never, confirmed - first_seen, -1)
+
+    def _flows(self, rows: np.ndarray) -> Dict[Tuple[int, int], Tuple[float, int]]:
+        pairs, inverse = np.unique(np.stack([self.flow_src[rows], self.flow_dst[rows]], 1), axis=0,
+                                   return_inverse=True)
+        inverse = inverse.reshape(-1)
+        amounts = np.bincount(inverse, self.flow_amount[rows], len(pairs))
+        counts = np.bincount(inverse, self.flow_count[rows], len(pairs)).round().astype(np.int64)
+        return {(int(src), int(dst)): (float(amount), int(count))
+                for (src, dst), amount, count in zip(pairs, amounts, counts) if count != 0}
+
+
+def _groups(keys: np.ndarray, num_keys: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param keys: Keys from 0 to num_keys - 1
+    :return: The rows sorted by key, keeping their order within a key, and the start of the rows of every key
+    """
+    order = np.argsort(keys, kind='stable')
+    return order, np.searchsorted(keys[order], np.arange(num_keys + 1))
+
+
+class _RunIndexBuilder:
+    """
+    The rows of the tables of a RunIndex, added step by step
+    """
+    def __init__(self, confirmations: int):
+        self.confirmations = confirmations
+        self.agents: Dict[int, str] = {}
+        self.addresses: Dict[str, int] = {}
+        self.address_agent: List[int] = []
+        self.wallet_agent: Dict[str, int] = {}
+        self.blocks: Dict[str, int] = {}
+        self.block_height: List[int] = []
+        self.block_first_seen: List[int] = []
+        self.block_confirmed: List[int] = []
+        self.txs: Dict[str, int] = {}
+        self.inclusion_tx: List[int] = []
+        self.inclusion_block: List[int] = []
+        self.io: Tuple[List[int], List[int], List[float]] = ([], [], [])
+        # Payments between agents of every block, by block
+        self.block_flows: List[List[Tuple[int, int, float]]] = []
+        self.flows: Tuple[List[int], List[int], List[int], List[float], List[int]] = ([], [], [], [], [])
+        self.master_length: List[int] = []
+        self.wealth: List[Dict[int, float]] = []
+        self.chain = ChainAnalytics()
+
+    def add(self, step: List[Dict]):
+        n = len(self.master_length)
+        for agent in step:
+            self.agents.setdefault(agent['id'], agent['type'])
+            for w in agent['wallets']:
+                if w['hash'] not in self.wallet_agent:
+                    self.wallet_agent[w['hash']] = agent['id']
+                    # The address can already be known from a transaction paying it before its wallet was seen
+                    self.address_agent[self._address(w['hash'])] = agent['id']
+
+        for chain in {x['blockchain']['hash']: x['blockchain'] for x in step}.values():
+            # Blocks are only new from the tip back to the first known one
+            blocks = chain['blocks']
+            position = len(blocks) - 1
+            while position >= 0 and blocks[position]['hash'] not in self.blocks:
+                position -= 1
+            for height in range(position + 1, len(blocks)):
+                self._block(blocks[height], height, n)
+
+        master = master_chain(step)['blocks']
+        balances, _ = self.chain.update(master, self.wallet_agent)
+        for sign, blocks in ((-1, self.chain.undone), (1, self.chain.applied)):
+            for block in blocks:
+                for src, dst, amount in self.block_flows[self.blocks[block['hash']]]:
+                    self.flows[0].append(n)
+                    self.flows[1].append(src)
+                    self.flows[2].append(dst)
+                    self.flows[3].append(sign * amount)
+                    self.flows[4].append(sign)
+        # Blocks reaching the depth of a confirmation, down to the first block which already had
+        position = len(master) - self.confirmations
+        while position >= 0 and self.block_confirmed[self.blocks[master[position]['hash']]] < 0:
+            self.block_confirmed[self.blocks[master[position]['hash']]] = n
+            position -= 1
+
+        wealth = defaultdict(float)
+        for address, agent in self.wallet_agent.items():
+            wealth[agent] += balances.get(address, 0)
+        self.master_length.append(len(master))
+        self.wealth.append(wealth)
+
+    def _address(self, address: str) -> int:
+        row = self.addresses.get(address)
+        if row is None:
+            row = self.addresses[address] = len(self.address_agent)
+            self.address_agent.append(self.wallet_agent.get(address, -1))
+        return row
+
+    def _block(self, block: Dict, height: int, step: int):
+        row = self.blocks[block['hash']] = len(self.block_height)
+        self.block_height.append(height)
+        self.block_first_seen.append(step)
+        self.block_confirmed.append(-1)
+        flows = []
+        for transaction in block['transactions']:
+            tx = self.txs.setdefault(transaction['hash'], len(self.txs))
+            inclusion = len(self.inclusion_tx)
+            self.inclusion_tx.append(tx)
+            self.inclusion_block.append(row)
+            for i in transaction['inputs']:
+                if i['address'] != 'reward':
+                    self._io(inclusion, i['address'], -i['amount'])
+            for o in transaction['outputs']:
+                self._io(inclusion, o['address'], o['amount'])
+            flows.extend(self._payments(transaction))
+        self.block_flows.append(flows)
+
+    def _io(self, inclusion: int, address: str, amount: float):
+        self.io[0].append(inclusion)
+        self.io[1].append(self._address(address))
+        self.io[2].append(amount)
+
+    def _payments(self, transaction: Dict) -> List[Tuple[int, int, float]]:
+        # The outputs to every other agent are paid by the agents of the inputs in proportion to their inputs
+        paid = defaultdict(float)
+        for i in transaction['inputs']:
+            if i['address'] != 'reward':
+                paid[self.wallet_agent.get(i['address'], -1)] += i['amount']
+        received = defaultdict(float)
+        for o in transaction['outputs']:
+            received[self.wallet_agent.get(o['address'], -1)] += o['amount']
+        total = sum(paid.values())
+        if total <= 0:
+            return []
+        return [(src, dst, amount * share / total) for src, share in paid.items() for dst, amount in received.items()
+                if src != dst and src >= 0 and dst >= 0]
+
+    def tables(self) -> Dict[str, np.ndarray]:
+        agent_id = np.array(sorted(self.agents), dtype=np.int64)
+        columns = {x: i for i, x in enumerate(agent_id.tolist())}
+        wealth = np.zeros((len(self.wealth), len(agent_id)))
+        for n, step_wealth in enumerate(self.wealth):
+            for agent, value in step_wealth.items():
+                wealth[n, columns[agent]] = value
+        return {
+            'agent_id': agent_id,
+            'agent_type': np.array([self.agents[x] for x in agent_id.tolist()], dtype=str),
+            'address': np.array(list(self.addresses), dtype=str),
+            'address_agent': np.array(self.address_agent, dtype=np.int64),
+            'block_hash': np.array(list(self.blocks), dtype=str),
+            'block_height': np.array(self.block_height, dtype=np.int64),
+            'block_first_seen': np.array(self.block_first_seen, dtype=np.int64),
+            'block_confirmed': np.array(self.block_confirmed, dtype=np.int64),
+            'tx_hash': np.array(list(self.txs), dtype=str),
+            'inclusion_tx': np.array(self.inclusion_tx, dtype=np.int64),
+            'inclusion_block': np.array(self.inclusion_block, dtype=np.int64),
+            'io_inclusion': np.array(self.io[0], dtype=np.int64),
+            'io_address': np.array(self.io[1], dtype=np.int64),
+            'io_amount': np.array(self.io[2], dtype=float),
+            'flow_step': np.array(self.flows[0], dtype=np.int64),
+            'flow_src': np.array(self.flows[1], dtype=np.int64),
+            'flow_dst': np.array(self.flows[2], dtype=np.int64),
+            'flow_amount': np.array(self.flows[3], dtype=float),
+            'flow_count': np.array(self.flows[4], dtype=np.int64),
+            'master_length': np.array(self.master_length, dtype=np.int64),
+            'wealth': wealth,
+            'confirmations': np.array(self.confirmations)
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index a recorded simulation into columnar tables')
+    parser.add_argument('simulation', help='A .jsonl file written by SimulationRecorder, a .json list of steps or a '
+                                           'pickled list of steps')
+    parser.add_argument('--out', default=None, help='The .npz file to write the tables to, next to the simulation if '
+                                                    'not given')
+    parser.add_argument('--confirmations', type=int, default=1)
+    parser.add_argument('--top', type=int, default=10, help='The number of the largest flows to print')
+    args = parser.parse_args()
+
+    with open_simulation(args.simulation) as simulation:
+        run_index = RunIndex.build(simulation, args.confirmations)
+    out_path = args.out or args.simulation.rsplit('.', 1)[0] + '.npz'
+    run_index.save(out_path)
+    print('Tables written to %s' % out_path)
+    for flow in run_index.top_flows(args.top):
+        print('%6d -> %-6d %12.4f in %d payments' % flow)
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+"""
+Benchmarks of the hot paths at several scales. Every scenario is built from a fixed seed, so runs on the same machine
+are comparable. Results are written as JSON and compared against a baseline written by an earlier run:
+
+    python3 benchmark.py --save-baseline               # on the reference commit
+    python3 benchmark.py --baseline benchmark_baseline.json
+
+A benchmark regresses when its fastest sample is more than threshold slower than in the baseline, and then the exit
+status is 1. The fastest sample is the one least disturbed by other work on the machine.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from random import Random
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+import ids
+from block import Block
+from blockchain import Blockchain
+from blocktree import BlockTree
+from transaction import Transaction, TxInput, TxOutput
+from wallet import Wallet
+
+SEED = 123
+
+# Agents of the models and blocks of the chains of every scale
+SCALES = {
+    'small': {'agents': 100, 'blocks': 100},
+    'medium': {'agents': 1000, 'blocks': 1000},
+    'large': {'agents': 10000, 'blocks': 10000}
+}
+
+
+def measure(func: Callable[[], None], repeat: int, min_time: float = 0.05) -> Dict[str, float]:
+    """
+    :param min_time: Calls are repeated until a sample takes at least this long, so that fast calls are not lost in
+    the resolution of the timer. Functions whose calls change the results of later calls should be measured with 0
+    :return: The median and minimum time of a call over repeat samples
+    """
+    number = 1
+    if min_time > 0:
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            if time.perf_counter() - start >= min_time:
+                break
+            number *= 2
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {'median': statistics.median(times), 'min': min(times), 'repeat': repeat, 'number': number}
+
+
+def build_chain(length: int, num_wallets: int, seed: int) -> Tuple[Blockchain, List[Wallet]]:
+    """
+    A chain where every block rewards a random wallet and moves part of an output of another wallet to a third one
+    """
+    rng = Random(seed)
+    ids.seed(seed)
+    model = SimpleNamespace(random=Random(seed), COIN_SELECTION='approximate')
+    genesis = Block('0', [])
+    chain = Blockchain(genesis, BlockTree(genesis))
+    wallets = [Wallet(model, context=chain) for _ in range(num_wallets)]
+    for _ in range(length):
+        receiver = rng.choice(wallets)
+        transactions = []
+        sender = rng.choice(wallets)
+        unspent = sender.unspent
+        if unspent:
+            outpoint, amount = rng.choice(list(unspent.items()))
+            sent = round(amount * rng.random(), 4)
+            transactions.append(Transaction([Transaction.spend(sender.key, outpoint, amount)],
+                                            [TxOutput(rng.choice(wallets).key, sent),
+                                             TxOutput(sender.key, amount - sent)]))
+        transactions.append(Transaction([TxInput('reward', 50)], [TxOutput(receiver.key, 50)], 'reward'))
+        chain.add(Block(chain.hash, transactions))
+    return chain, wallets
+
+
+def build_model(num_agents: int, steps: int, seed: int):
+    from MoneyModel import MoneyModel
+
+    random.seed(seed)
+    model = MoneyModel(num_agents, seed=seed)
+    for _ in range(steps):
+        model.step()
+    return model
+
+
+def chain_benchmarks(scale: Dict, repeat: int) -> Dict[str, Dict]:
+    chain, wallets = build_chain(scale['blocks'], max(scale['blocks'] // 10, 10), SEED)
+    funded = [x for x in wallets if x.balance > 0][:100]
+    return {
+        'wallet.balance': measure(lambda: [x.balance for x in wallets], repeat),
+        'wallet.utxo': measure(lambda: [x.utxo for x in wallets], repeat),
+        'wallet.get_utxo': measure(lambda: [x.get_utxo(x.balance / 2) for x in funded], repeat)
+    }
+
+
+def model_benchmarks(scale: Dict, repeat: int) -> Dict[str, Dict]:
+    model = build_model(scale['agents'], 2, SEED)
+    from entity import Miner
+    miners = model.get_agents(Miner)[:50]
+    agents = model.schedule.agents
+    results = {
+        'miner.mine': measure(lambda: [x.mine() for x in miners], repeat),
+        'entity.common': measure(lambda: [x.common() for x in agents], repeat),
+        'model.step': measure(model.step, repeat, 0)
+    }
+
+    # Keyframes are built from a recorded simulation
+    try:
+        from visualize import build_keyframe
+        from analytics import ChainAnalytics
+    except ImportError as e:
+        results['visualize.build_keyframe'] = {'skipped': 'visualize can not be imported: %s' % e}
+        return results
+    from recorder import SimulationRecorder, SimulationReader
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'simulation.jsonl')
+        with SimulationRecorder(path) as recorder:
+            for _ in range(repeat):
+                model.step()
+                recorder.record(model)
+        steps = list(SimulationReader(path))
+
+        def build_keyframes():
+            # As visualize does, carrying the analytics of the master chain from step to step
+            analytics = ChainAnalytics()
+            return [build_keyframe(x, analytics) for x in steps]
+        results['visualize.build_keyframe'] = measure(build_keyframes, repeat)
+    return results
+
+
+def run(scales: List[str], repeat: int) -> Dict:
+    results = {}
+    for name in scales:
+        print('Running %s scale' % name, file=sys.stderr)
+        for benchmark, result in chain_benchmarks(SCALES[name], repeat).items():
+            results['%s/%s' % (benchmark, name)] = result
+        for benchmark, result in model_benchmarks(SCALES[name], repeat).items():
+            results['%s/%s' % (benchmark, name)] = result
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': SEED,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Print the times against the baseline
+    :return: The names of the benchmarks which are more than threshold slower than in the baseline
+    """
+    regressions = []
+    print('%-36s %12s %12s %8s' % ('benchmark', 'min (s)', 'baseline (s)', 'ratio'))
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name, {})
+        if 'min' not in result or 'min' not in base:
+            print('%-36s %12s %12s %8s' % (name, '%.6f' % result['min'] if 'min' in result else '-', '-', '-'))
+            continue
+        ratio = result['min'] / base['min'] if base['min'] > 0 else 1
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print('%-36s %12.6f %12.6f %7.2fx%s' % (name, result['min'], base['min'], ratio,
+                                                 ' REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the simulation')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', default='benchmark.json', help='The file to write the results to')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='The fraction a benchmark may be slower than the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline')
+    args = parser.parse_args()
+
+    benchmark_results = run(args.scales, args.repeat)
+    with open(args.out, 'w') as out_file:
+        json.dump(benchmark_results, out_file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(benchmark_results, baseline_file, indent=2)
+        print('Baseline written to %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            if compare(benchmark_results, json.load(baseline_file), args.threshold):
+                sys.exit(1)
+    else:
+        print('No baseline at %s, run with --save-baseline to create one' % args.baseline)
@@ -1,14 +1,32 @@
 from transaction import Transaction
 from typing import List, Dict
-from uuid import uuid4
+from ids import new_id
 
 
 class Block:
+    __slots__ = ('prev', 'transactions', 'reward', 'id', 'parent', 'skip', 'height', 'work', 'chain_work')
+
     def __init__(self, prev: str, transactions: List[Transaction]):
         self.prev = prev
         self.transactions = transactions
         self.reward = []
-        self.id = str(uuid4())
+        self.id = new_id()
+        # The position of the block is set when it is added to a BlockTree
+        self.parent = None
+        self.skip = None
+        self.height = None
+        self.work = 1
+        self.chain_work = 0
+
+    def __getstate__(self):
+        # parent and skip are linked again by the BlockTree, so that pickling a long chain does not recurse through it
+        return {x: getattr(self, x) for x in self.__slots__ if x not in ('parent', 'skip')}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.parent = None
+        self.skip = None
 
     def to_dict(self):
         return {
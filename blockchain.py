@@ -1,63 +1,98 @@
 from typing import List, Dict
 from block import Block
+from blocktree import BlockTree
 from transaction import Transaction
-from copy import copy
+from chainstate import ChainState
 
 
 class Blockchain:
-    blocks: List[Block]
-    hash: str
+    """
+    A chain in a BlockTree identified by its tip. Copies of a chain share the tree and only hold their own tip.
+    """
+    tree: BlockTree
+    tip: Block
 
     # TODO Model constructor
-    def __init__(self, genesis: Block):
-        self.blocks = [genesis]
-        self.hash = genesis.id
+    def __init__(self, genesis: Block, tree: BlockTree = None):
+        """
+        :param genesis: The first block of the chain
+        :param tree: The tree the chain is part of. A new tree rooted at genesis is created if it is not given
+        """
+        if not tree:
+            tree = BlockTree(genesis)
+        self.tree = tree
+        self.tip = genesis
+
+    @property
+    def hash(self) -> str:
+        return self.tip.id
+
+    @property
+    def blocks(self) -> List[Block]:
+        return self.tree.chain(self.tip)
+
+    @property
+    def state(self) -> ChainState:
+        return self.tree.state(self.tip)
 
     def get_hash(self) -> str:
-        return self.blocks[-1].id
-
-    def to_dict(self):
+        return self.tip.id
+
+    def to_dict(self, include_blocks: bool = True):
+        if not include_blocks:
+            return {
+                'hash': self.get_tail().id,
+                'length': len(self)
+            }
         return {
             'blocks': [x.to_dict() for x in self.blocks],
             'hash': self.get_tail().id
         }
 
+    def balance(self, address: str) -> float:
+        return self.state.balance(address)
+
     def get_tail(self) -> Block:
-        return self.blocks[-1]
+        return self.tip
 
     def get_block(self, identifier: str) -> Block:
-        for block in self.blocks:
-            if block.id == identifier:
-                return block
-        raise BlockNotFoundException
+        block = self.tree.blocks.get(identifier)
+        if block is None or not self.contains(block):
+            raise BlockNotFoundException(identifier)
+        return block
+
+    def contains(self, block: Block) -> bool:
+        return self.tree.is_ancestor(block, self.tip)
 
     def transaction_exists(self, tr: Transaction) -> bool:
-        for block in self.blocks:
-            if block.transaction_exists(tr):
-                return True
-        return False
+        return any(self.contains(block) for block in self.tree.tx_index.get(tr.id, ()))
+
+    def unconfirmed(self, txs: List[Transaction]) -> List[Transaction]:
+        """
+        :param txs: A list of transactions
+        :return: The transactions which are not in this chain
+        """
+        tx_index = self.tree.tx_index
+        return [x for x in txs if x.id not in tx_index or not self.transaction_exists(x)]
 
     def block_exists(self, b: Block) -> bool:
-        for block in self.blocks:
-            if block.id == b.id:
-                return True
-        return False
+        block = self.tree.blocks.get(b.id)
+        return block is not None and self.contains(block)
+
+    def common_ancestor(self, other: 'Blockchain') -> Block:
+        return self.tree.common_ancestor(self.tip, other.tip)
 
     def __len__(self):
-        return len(self.blocks)
+        return self.tip.height + 1
 
     def add(self, block: Block):
         # TODO resolve conflicts
-        last_block = self.get_tail()
-        block.prev = last_block.id
-        self.blocks.append(block)
-        self.hash = self.get_tail().id
+        self.tree.add(self.tip, block)
+        self.tip = block
 
     def __copy__(self) -> 'Blockchain':
-        # TODO implement this
-        bc_copy = Blockchain(self.blocks[0])
-        bc_copy.blocks = copy(self.blocks)
-        bc_copy.hash = self.hash
+        bc_copy = Blockchain(self.tree.genesis, self.tree)
+        bc_copy.tip = self.tip
         return bc_copy
 
     def queue_transaction(self):
@@ -66,5 +101,4 @@ class Blockchain:
 
 class BlockNotFoundException(Exception):
     def __init__(self, message: str):
-        super(message)
-
+        super(BlockNotFoundException, self).__init__(message)
@@ -0,0 +1,181 @@
+from copy import copy
+from typing import Dict, List, Tuple, Optional
+from block import Block
+from chainstate import ChainState
+from cache import LRUCache
+
+
+def _invert_lowest_one(n: int) -> int:
+    return n & (n - 1)
+
+
+def _skip_height(height: int) -> int:
+    """
+    The height a block skips back to. Any ancestor can be reached in O(log n) jumps, see
+    https://github.com/bitcoin/bitcoin/blob/v0.20.0/src/chain.cpp#L70
+    """
+    if height < 2:
+        return 0
+    if height & 1:
+        return _invert_lowest_one(_invert_lowest_one(height - 1)) + 1
+    return _invert_lowest_one(height)
+
+
+class BlockTree:
+    """
+    All the blocks known to a model. Every block points to its parent so that a chain is identified by its tip block
+    and chains share their common prefix.
+    """
+    genesis: Block
+    blocks: Dict[str, Block]
+    tx_index: Dict[str, List[Block]]
+    states: LRUCache
+
+    def __init__(self, genesis: Block, max_states: int = 16):
+        """
+        :param genesis: The root of the tree
+        :param max_states: The number of chain tips for which the ChainState is kept. Every state holds the unspent
+        outputs and balances of its chain, so this trades memory against deriving states again
+        """
+        genesis.parent = None
+        genesis.skip = None
+        genesis.height = 0
+        genesis.chain_work = genesis.work
+        self.genesis = genesis
+        self.blocks = {}
+        self.tx_index = {}
+        self._index(genesis)
+
+        state = ChainState()
+        state.apply(genesis)
+        self.states = LRUCache(max_states)
+        self.states.put(genesis.id, state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Blocks are pickled without their links to other blocks. Parents have a lower height than their children, so
+        # linking the blocks in order of height finds the skip pointers of the ancestors already in place
+        for block in sorted(self.blocks.values(), key=lambda x: x.height):
+            if block is self.genesis:
+                continue
+            block.parent = self.blocks[block.prev]
+            block.skip = self.ancestor(block.parent, _skip_height(block.height))
+
+    def add(self, parent: Block, block: Block):
+        """
+        Add a block as a child of parent
+        """
+        block.prev = parent.id
+        block.parent = parent
+        block.height = parent.height + 1
+        block.chain_work = parent.chain_work + block.work
+        block.skip = self.ancestor(parent, _skip_height(block.height))
+        self._index(block)
+
+        # Advance the state of the parent instead of deriving the state of the new tip later. The parent state can be
+        # recovered by disconnecting the block if it is needed again
+        state = self.states.pop(parent.id, None)
+        if state is not None:
+            state.apply(block)
+            self.states.put(block.id, state)
+
+    def _index(self, block: Block):
+        self.blocks[block.id] = block
+        for tx in block.transactions:
+            self.tx_index.setdefault(tx.id, []).append(block)
+
+    def ancestor(self, block: Block, height: int) -> Optional[Block]:
+        """
+        :return: The ancestor of block at the given height
+        """
+        if height > block.height or height < 0:
+            return None
+        walk = block
+        while walk.height > height:
+            # The skip heights are read from the blocks instead of being recomputed with _skip_height
+            skip = walk.skip
+            if skip is not None:
+                height_skip = skip.height
+                parent_skip = walk.parent.skip
+                height_skip_prev = parent_skip.height if parent_skip is not None else 0
+                if height_skip == height or (height_skip > height and not (height_skip_prev < height_skip - 2
+                                                                           and height_skip_prev >= height)):
+                    walk = skip
+                    continue
+            walk = walk.parent
+        return walk
+
+    def is_ancestor(self, ancestor: Block, block: Block) -> bool:
+        return ancestor.height is not None and self.ancestor(block, ancestor.height) is ancestor
+
+    def common_ancestor(self, a: Block, b: Block) -> Block:
+        if a.height > b.height:
+            a = self.ancestor(a, b.height)
+        elif b.height > a.height:
+            b = self.ancestor(b, a.height)
+        while a is not b:
+            # Both blocks are at the same height so their skip pointers are at the same height as well
+            if a.skip is not None and a.skip is not b.skip:
+                a = a.skip
+                b = b.skip
+            else:
+                a = a.parent
+                b = b.parent
+        return a
+
+    def path(self, source: Block, target: Block) -> Tuple[List[Block], List[Block]]:
+        """
+        :return: The blocks to disconnect from source (tip first) and the blocks to connect (oldest first) to move
+        from the chain ending at source to the chain ending at target
+        """
+        fork = self.common_ancestor(source, target)
+        disconnect = []
+        while source is not fork:
+            disconnect.append(source)
+            source = source.parent
+        connect = []
+        while target is not fork:
+            connect.append(target)
+            target = target.parent
+        connect.reverse()
+        return disconnect, connect
+
+    def chain(self, tip: Block) -> List[Block]:
+        """
+        :return: The blocks from genesis up to tip
+        """
+        blocks = []
+        while tip is not None:
+            blocks.append(tip)
+            tip = tip.parent
+        blocks.reverse()
+        return blocks
+
+    def state(self, tip: Block) -> ChainState:
+        """
+        The ChainState at tip. States are kept for the most recently used tips, any other state is derived from the
+        closest kept state by disconnecting and connecting blocks. The returned state should not be held on to while
+        states for other tips are requested.
+        """
+        state = self.states.get(tip.id)
+        if state is not None:
+            return state
+
+        if not self.states.is_full():
+            source = min((self.blocks[x] for x in self.states), key=lambda x: self._distance(x, tip))
+            state = copy(self.states.peek(source.id))
+        else:
+            # Reuse the least recently used state
+            source_id, state = self.states.evict()
+            source = self.blocks[source_id]
+
+        disconnect, connect = self.path(source, tip)
+        for block in disconnect:
+            state.undo(block)
+        for block in connect:
+            state.apply(block)
+        self.states.put(tip.id, state)
+        return state
+
+    def _distance(self, a: Block, b: Block) -> int:
+        return a.height + b.height - 2 * self.common_ancestor(a, b).height
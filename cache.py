@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple
+
+
+class LRUCache:
+    """
+    A mapping with a maximum size which evicts the least recently used entry. Hits, misses and evictions are counted
+    so that the size can be tuned against the cost of recomputing evicted entries.
+    """
+    def __init__(self, maxsize: int):
+        """
+        :param maxsize: The maximum number of entries
+        """
+        if maxsize < 1:
+            raise ValueError('LRUCache: maxsize has to be at least 1')
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._entries)
+
+    def resize(self, maxsize: int):
+        """
+        Change the maximum number of entries, evicting the least recently used entries above it
+        """
+        if maxsize < 1:
+            raise ValueError('LRUCache: maxsize has to be at least 1')
+        self.maxsize = maxsize
+        while len(self._entries) > maxsize:
+            self.evict()
+
+    def is_full(self) -> bool:
+        return len(self._entries) >= self.maxsize
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Look up a key, marking it as recently used and counting a hit or a miss
+        """
+        value = self._entries.get(key, default)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Look up a key without changing the order or the counters
+        """
+        return self._entries.get(key, default)
+
+    def put(self, key: Hashable, value: Any) -> Optional[Tuple[Hashable, Any]]:
+        """
+        :return: The entry which was evicted to make room, if any
+        """
+        evicted = None
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        elif self.is_full():
+            evicted = self.evict()
+        self._entries[key] = value
+        return evicted
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        return self._entries.pop(key, default)
+
+    def evict(self) -> Tuple[Hashable, Any]:
+        """
+        Remove the least recently used entry
+        """
+        self.evictions += 1
+        return self._entries.popitem(last=False)
+
+    def stats(self, reset: bool = False) -> Dict[str, int]:
+        """
+        :param reset: Whether to reset the counters after reading them
+        :return: The counters and the size of the cache
+        """
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+        if reset:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        return stats
@@ -0,0 +1,161 @@
+from typing import Dict, Iterable, Set, Optional
+import math
+import typing
+
+from transaction import Outpoint, Transaction, TxOutput
+
+if typing.TYPE_CHECKING:
+    from block import Block
+
+
+class ChainState:
+    """
+    The unspent transaction outputs and the balances of addresses at the tail of a chain. Outputs are addressed by
+    their outpoint (transaction id, output index) and indexed by the address they are paid to.
+    """
+    utxo: Dict[Outpoint, TxOutput]
+    address_utxo: Dict[str, Dict[Outpoint, float]]
+    balances: Dict[str, float]
+
+    def __init__(self):
+        self.utxo = {}
+        self.address_utxo = {}
+        self.balances = {}
+
+    def unspent(self, address: str) -> Dict[Outpoint, float]:
+        """
+        :param address: The address of a wallet
+        :return: The unspent outputs of the address as {outpoint: amount}
+        """
+        return self.address_utxo.get(address, {})
+
+    def balance(self, address: str) -> float:
+        return self.balances.get(address, 0)
+
+    def is_unspent(self, outpoint: Outpoint) -> bool:
+        return outpoint in self.utxo
+
+    def apply(self, block: 'Block'):
+        for tx in block.transactions:
+            self._connect(tx)
+        self._update_balances(block.transactions)
+
+    def apply_transaction(self, tx: Transaction):
+        self._connect(tx)
+        self._update_balances([tx])
+
+    def _connect(self, tx: Transaction):
+        for i in tx.inputs:
+            # Inputs without an outpoint (block rewards) do not spend anything
+            if i.txid is not None:
+                self.spend((i.txid, i.vout))
+        for index, o in enumerate(tx.outputs):
+            self.create((tx.id, index), o)
+
+    def undo(self, block: 'Block'):
+        """
+        Disconnect block, which has to be the last block applied to this state
+        """
+        for tx in reversed(block.transactions):
+            self._disconnect(tx)
+        self._update_balances(block.transactions)
+
+    def undo_transaction(self, tx: Transaction):
+        self._disconnect(tx)
+        self._update_balances([tx])
+
+    def _disconnect(self, tx: Transaction):
+        for index, o in enumerate(tx.outputs):
+            self.spend((tx.id, index))
+        # The inputs carry the address and amount of the outputs they spent, so they can be restored from the block
+        for i in tx.inputs:
+            if i.txid is not None:
+                self.create((i.txid, i.vout), TxOutput(i.address, i.amount))
+
+    def _update_balances(self, txs: Iterable[Transaction]):
+        # The balances of the addresses the transactions touched are summed again from their unspent outputs instead of
+        # adjusted by the amounts, so that undoing a block restores them exactly
+        addresses = set()
+        for tx in txs:
+            addresses.update([i.address for i in tx.inputs if i.txid is not None])
+            addresses.update([o.address for o in tx.outputs])
+        for address in addresses:
+            outputs = self.address_utxo.get(address)
+            if outputs:
+                self.balances[address] = math.fsum(outputs.values())
+            else:
+                self.balances.pop(address, None)
+
+    def create(self, outpoint: Outpoint, output: TxOutput):
+        self.utxo[outpoint] = output
+        self.address_utxo.setdefault(output.address, {})[outpoint] = output.amount
+
+    def spend(self, outpoint: Outpoint):
+        address, _ = self.utxo.pop(outpoint)
+        address_outputs = self.address_utxo[address]
+        del address_outputs[outpoint]
+        if not address_outputs:
+            del self.address_utxo[address]
+
+    def __copy__(self) -> 'ChainState':
+        state_copy = ChainState()
+        state_copy.utxo = self.utxo.copy()
+        state_copy.address_utxo = {k: v.copy() for k, v in self.address_utxo.items()}
+        state_copy.balances = self.balances.copy()
+        return state_copy
+
+
+class ValidationState:
+    """
+    Transactions applied on top of a ChainState without modifying it. Used to validate the transactions of a block
+    before it is added to the chain.
+    """
+    state: ChainState
+    spent: Set[Outpoint]
+    created: Dict[Outpoint, TxOutput]
+
+    def __init__(self, state: ChainState):
+        self.state = state
+        self.spent = set()
+        self.created = {}
+
+    def output(self, outpoint: Outpoint) -> Optional[TxOutput]:
+        """
+        :return: The output at outpoint if it is unspent, otherwise None
+        """
+        if outpoint in self.spent:
+            return None
+        output = self.created.get(outpoint)
+        if output is None:
+            output = self.state.utxo.get(outpoint)
+        return output
+
+    def is_valid(self, tx: Transaction) -> bool:
+        """
+        A transaction is valid if every input spends a distinct unspent output with the same address and amount
+        """
+        outpoints = set()
+        for i in tx.inputs:
+            if i.txid is None:
+                return False
+            outpoint = (i.txid, i.vout)
+            output = self.output(outpoint)
+            if output is None or outpoint in outpoints or output.address != i.address or output.amount != i.amount:
+                return False
+            outpoints.add(outpoint)
+        return True
+
+    def apply(self, tx: Transaction) -> bool:
+        """
+        Apply tx if it is valid
+        :return: Whether tx was applied
+        """
+        if not self.is_valid(tx):
+            return False
+        for i in tx.inputs:
+            outpoint = (i.txid, i.vout)
+            if self.created.pop(outpoint, None) is None:
+                self.spent.add(outpoint)
+        for index, o in enumerate(tx.outputs):
+            self.created[(tx.id, index)] = o
+        return True
@@ -0,0 +1,264 @@
+"""
+Coin selection strategies. A strategy picks unspent outputs of a wallet whose amounts add up to at least a target.
+Every strategy takes the amounts of the outputs, the target and the random number generator of the model, and
+returns the indices of the selected amounts, or None if it does not find a selection.
+"""
+from random import Random
+from typing import List, Optional, Callable, Dict, Tuple
+import numpy as np
+
+# Selections short of the target by less than this are accepted, the amounts are floats
+TOLERANCE = 1e-8
+
+
+def _smallest_greater(amounts: List[float], target: float) -> Optional[int]:
+    greater = [i for i, x in enumerate(amounts) if x > target]
+    if len(greater) == 0:
+        return None
+    return min(greater, key=lambda i: amounts[i])
+
+
+def _knapsack(amounts: List[float], target: float, rng: Random,
+              best_subset: Callable[[List[float], float, Random], Tuple[List[bool], float]]) -> Optional[List[int]]:
+    # https://github.com/bitcoin/bitcoin/blob/3015e0bca6bc2cb8beb747873fdf7b80e74d679f/src/wallet.cpp#L1276
+    # If any of your UTXO² matches the Target¹ it will be used.
+    for i, x in enumerate(amounts):
+        if x == target:
+            return [i]
+
+    # If the "sum of all your UTXO smaller than the Target" happens to match the Target, they will be used.
+    # (This is the case if you sweep a complete wallet.)
+    smaller = [i for i, x in enumerate(amounts) if x < target]
+    smaller_sum = sum([amounts[i] for i in smaller])
+    if smaller_sum == target:
+        return smaller
+
+    # If the "sum of all your UTXO smaller than the Target" doesn't surpass the target,
+    # the smallest UTXO greater than your Target will be used.
+    # TODO Transaction Fee simulation
+    if smaller_sum < target:
+        min_greater = _smallest_greater(amounts, target)
+        if min_greater is not None:
+            return [min_greater]
+        # There are not enough funds, unless the smaller outputs only miss the target by a rounding error
+        if target - smaller_sum <= TOLERANCE:
+            return smaller
+        return None
+
+    # Else Bitcoin Core randomly combines unspent transaction outputs until their sum is greater than or equal to the
+    # Target.
+    included, best_sum = best_subset(amounts, target, rng)
+    best = [i for i, b in enumerate(included) if b]
+    if best_sum == target:
+        return best
+
+    # Otherwise it finally settles for the minimum of
+    #     the smallest UTXO greater than the Target
+    #     the smallest combination of UTXO it discovered in Step 4.
+    min_greater = _smallest_greater(amounts, target)
+    if min_greater is not None and amounts[min_greater] <= best_sum:
+        return [min_greater]
+    return best
+
+
+def _approximate_best_subset(amounts: List[float], target: float, rng: Random) -> Tuple[List[bool], float]:
+    # 1000 rounds of randomly combining unspent transaction outputs. If it happens to find an exact match, it stops
+    # early and uses that.
+    # https://github.com/bitcoin/bitcoin/blob/3015e0bca6bc2cb8beb747873fdf7b80e74d679f/src/wallet.cpp#L1129
+    vfBest = [True] * len(amounts)
+    nBest = sum(amounts)
+    nRep = 0
+    while nRep < 1000 and nBest != target:
+        vIncluded = [False] * len(amounts)
+        nTotal = 0
+        fReachedTarget = False
+        nPass = 0
+        while nPass < 2 and not fReachedTarget:
+            for i in range(len(amounts)):
+                if nPass == 0 and rng.choice([True, False]) or not vIncluded[i]:
+                    nTotal += amounts[i]
+                    vIncluded[i] = True
+                    if nTotal >= target:
+                        fReachedTarget = True
+                        if nTotal < nBest:
+                            nBest = nTotal
+                            vfBest = vIncluded.copy()
+                        nTotal -= amounts[i]
+                        vIncluded[i] = False
+            nPass += 1
+        nRep += 1
+    return vfBest, nBest
+
+
+def _vectorized_best_subset(amounts: List[float], target: float, rng: Random,
+                            rounds: int = 1000, max_batch_elements: int = 2 ** 20) -> Tuple[List[bool], float]:
+    # Every round tries a random subset and the shortest prefix of a random order of the outputs which reaches the
+    # target. Rounds are evaluated in batches with NumPy and the search stops early on an exact match.
+    values = np.asarray(amounts, dtype=float)
+    n = len(values)
+    generator = np.random.default_rng(rng.getrandbits(64))
+    best = np.ones(n, dtype=bool)
+    best_sum = values.sum()
+    batch = max(1, min(rounds, max_batch_elements // max(n, 1)))
+    done = 0
+    while done < rounds and best_sum != target:
+        size = min(batch, rounds - done)
+        done += size
+        keys = generator.random((size, n))
+
+        masks = keys < 0.5
+        sums = masks @ values
+        sums[sums < target] = np.inf
+        k = int(np.argmin(sums))
+        if sums[k] < best_sum:
+            best_sum = sums[k]
+            best = masks[k]
+
+        order = np.argsort(keys, axis=1)
+        prefix = np.cumsum(values[order], axis=1)
+        reached = prefix >= target
+        first = np.argmax(reached, axis=1)
+        totals = prefix[np.arange(size), first]
+        totals[~reached[np.arange(size), first]] = np.inf
+        k = int(np.argmin(totals))
+        if totals[k] < best_sum:
+            best_sum = totals[k]
+            best = np.zeros(n, dtype=bool)
+            best[order[k, :first[k] + 1]] = True
+    return best.tolist(), float(best_sum)
+
+
+def knapsack(amounts: List[float], target: float, rng: Random) -> Optional[List[int]]:
+    """
+    The Bitcoin Core knapsack solver with its 1000 round random search in pure Python
+    """
+    return _knapsack(amounts, target, rng, _approximate_best_subset)
+
+
+def approximate(amounts: List[float], target: float, rng: Random) -> Optional[List[int]]:
+    """
+    The Bitcoin Core knapsack solver with the random search done in batches with NumPy
+    """
+    return _knapsack(amounts, target, rng, _vectorized_best_subset)
+
+
+def branch_and_bound(amounts: List[float], target: float, rng: Random,
+                     tolerance: float = TOLERANCE, max_tries: int = 100000) -> Optional[List[int]]:
+    """
+    Depth first search for the selection with the least change, only accepting selections within tolerance of the
+    target. Returns None if there is no such selection.
+    https://github.com/bitcoin/bitcoin/blob/v0.20.0/src/wallet/coinselection.cpp#L21
+    """
+    order = sorted(range(len(amounts)), key=lambda i: amounts[i], reverse=True)
+    values = [amounts[i] for i in order]
+    curr_available = sum(values)
+    if curr_available < target:
+        return None
+
+    curr_value = 0
+    curr_selection: List[bool] = []
+    best_selection = None
+    best_excess = tolerance
+    for _ in range(max_tries):
+        backtrack = False
+        if curr_value + curr_available < target or curr_value > target + tolerance:
+            # The target can not be reached or the selection is out of range
+            backtrack = True
+        elif curr_value < target and len(curr_selection) == len(values):
+            # Every output was considered. curr_available can be left with a rounding error instead of zero
+            backtrack = True
+        elif curr_value >= target:
+            if curr_value - target <= best_excess:
+                best_selection = curr_selection.copy()
+                best_excess = curr_value - target
+                if best_excess == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            # Walk back to the last included output, and try excluding it
+            while curr_selection and not curr_selection[-1]:
+                curr_selection.pop()
+                curr_available += values[len(curr_selection)]
+            if not curr_selection:
+                break
+            curr_selection[-1] = False
+            curr_value -= values[len(curr_selection) - 1]
+        else:
+            value = values[len(curr_selection)]
+            curr_available -= value
+            # Including an output with the same amount as an excluded previous output gives the same selections
+            if curr_selection and not curr_selection[-1] and value == values[len(curr_selection) - 1]:
+                curr_selection.append(False)
+            else:
+                curr_selection.append(True)
+                curr_value += value
+
+    if best_selection is None:
+        return None
+    return [order[i] for i, b in enumerate(best_selection) if b]
+
+
+def largest_first(amounts: List[float], target: float, rng: Random) -> Optional[List[int]]:
+    """
+    Select the largest outputs until the target is reached
+    """
+    selected = []
+    total = 0
+    for i in sorted(range(len(amounts)), key=lambda i: amounts[i], reverse=True):
+        if total >= target:
+            break
+        selected.append(i)
+        total += amounts[i]
+    return selected if total >= target - TOLERANCE else None
+
+
+STRATEGIES: Dict[str, Callable[[List[float], float, Random], Optional[List[int]]]] = {
+    'knapsack': knapsack,
+    'approximate': approximate,
+    'branch_and_bound': branch_and_bound,
+    'largest_first': largest_first
+}
+
+
+def select_coins(amounts: List[float], target: float, rng: Random, strategy: str = 'approximate') -> List[int]:
+    """
+    :param amounts: The amounts of the unspent outputs
+    :param target: The amount to spend
+    :param rng: The random number generator of the model
+    :param strategy: The name of a strategy in STRATEGIES. If it does not find a selection, approximate is used
+    :return: The indices of the selected outputs. Empty if the outputs do not add up to the target
+    """
+    selected = STRATEGIES[strategy](amounts, target, rng)
+    if selected is None:
+        selected = approximate(amounts, target, rng)
+    # Sums computed by NumPy can differ in the last bits from the sum of the inputs of the transaction
+    if selected is None or sum([amounts[i] for i in selected]) < target:
+        selected = largest_first(amounts, target, rng)
+    return selected or []
+
+
+if __name__ == "__main__":
+    import time
+    import sys
+
+    # Compare the strategies on random wallets: the time taken, how often the change is zero, the average change and
+    # the average number of inputs
+    num_wallets = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    wallet_rng = Random(123)
+    wallets = []
+    for _ in range(num_wallets):
+        utxo = [round(wallet_rng.uniform(0.0001, 2), 4) for _ in range(wallet_rng.randint(2, 60))]
+        target = round(wallet_rng.uniform(0.1, 0.9) * sum(utxo), 4)
+        wallets.append((utxo, target))
+
+    print('%-18s %10s %8s %12s %8s' % ('strategy', 'time (s)', 'exact', 'avg change', 'inputs'))
+    for name in STRATEGIES:
+        rng = Random(123)
+        start = time.perf_counter()
+        selections = [select_coins(utxo, target, rng, name) for utxo, target in wallets]
+        elapsed = time.perf_counter() - start
+        changes = [sum([utxo[i] for i in s]) - target for (utxo, target), s in zip(wallets, selections)]
+        exact = sum([1 for x in changes if abs(x) < 1e-8])
+        inputs = sum([len(s) for s in selections]) / len(selections)
+        print('%-18s %10.4f %8d %12.6f %8.2f' % (name, elapsed, exact, sum(changes) / len(changes), inputs))
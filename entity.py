@@ -1,18 +1,20 @@
 from __future__ import annotations
 from collections import defaultdict
-from typing import List, Dict, Union
+from typing import List, Union
 from wallet import Wallet
 from mesa import Agent, Model
 # from MoneyModel import MoneyModel
 from block import Block
 from blockchain import Blockchain
+from chainstate import ValidationState
 import random
-from transaction import Transaction
+from transaction import Transaction, TxInput, TxOutput
 import typing
 from copy import copy
 
 if typing.TYPE_CHECKING:
     from MoneyModel import MoneyModel
+    from population import StepDecisions
 
 
 class Entity(Agent):
@@ -34,11 +36,14 @@ class Entity(Agent):
         self.seller = seller
         self.add_wallet()
 
-    def to_dict(self):
+    def to_dict(self, include_blocks: bool = True):
+        """
+        :param include_blocks: Whether to include the blocks of the chain the agent follows, or only its tip
+        """
         return {
             'id': self.unique_id,
             'habits': self.habits,
-            'blockchain': self.blockchain.to_dict(),
+            'blockchain': self.blockchain.to_dict(include_blocks),
             'temperature': self.temperature,
             'wallets': [x.to_dict() for x in self.wallets],
             'attributes': self.attributes,
@@ -47,10 +52,11 @@ class Entity(Agent):
 
     def tx_from_wallets(self, amount: float,
                         from_wallets: List[Wallet], to_wallet: Wallet, change_wallet: Wallet,
-                        context=None) -> Transaction:
+                        context=None) -> Union[Transaction, None]:
         """
 
         :rtype: Transaction
+        :return: The transaction, or None if the wallets can not pay the amount
         """
         if not context:
             context = self.blockchain
@@ -65,7 +71,7 @@ class Entity(Agent):
         t_amount = 0
         i = 0
 
-        while t_amount < amount:
+        while t_amount < amount and i < len(wallets):
             sending_wallets.append(wallets[i])
             t_amount += wallets[i].balance
             i += 1
@@ -77,18 +83,21 @@ class Entity(Agent):
             #     print('wtf')
             #     print(i.utxo)
             #     print(i.balance)
-            one_from = [{'address': i.key, 'amount': x} for x in i.utxo]
+            one_from = [Transaction.spend(i.key, outpoint, x) for outpoint, x in i.unspent.items()]
             for j in one_from:
                 transactions_from.append(j)
 
         running_total = sum([x.balance for x in sending_wallets[:-1]])
 
-        final_utxo, final_change = sending_wallets[-1].get_utxo(amount - running_total)
+        selection = sending_wallets[-1].get_utxo(amount - running_total)
+        if selection is None:
+            return None
+        final_utxo, final_change = selection
         final_key = sending_wallets[-1].key
         self.random.shuffle(final_utxo)
 
-        for i in final_utxo:
-            transactions_from.append({'address': final_key, 'amount': i})
+        for outpoint, i in final_utxo:
+            transactions_from.append(Transaction.spend(final_key, outpoint, i))
 
         # for i in final_utxo:
         #     transactions_from.append({'address': final_key, 'amount': i})
@@ -101,8 +110,8 @@ class Entity(Agent):
         # Create a change address
         # change_wallet = Wallet(self.model)
 
-        transactions_to = [{'address': change_wallet.key, 'amount': change},
-                           {'address': to_wallet.key, 'amount': amount}]
+        transactions_to = [TxOutput(change_wallet.key, change),
+                           TxOutput(to_wallet.key, amount)]
 
         transaction = Transaction(transactions_from, transactions_to)
         return transaction
@@ -115,18 +124,18 @@ class Entity(Agent):
     def get_total_wealth(self, context=None) -> float:
         if not context:
             context = self.blockchain
-        wallets = self.wallets.copy()
-        for w in wallets:
-            w.context = context
-        return sum([x.balance for x in wallets])
+        return sum([context.balance(x.key) for x in self.wallets])
 
-    def simulate_transactions(self):
+    def simulate_transactions(self, temperature_reached: bool = None):
+        """
+        :param temperature_reached: Whether the agent spends on a habit. It is drawn from the temperature if None
+        """
         self.refresh_wallet_context()
         # Buy currency using exchange
         buy_decision = self.random.random()
         if buy_decision < 0.5:
             # Select an appropriate exchange
-            exchanges = [x for x in self.model.schedule.agents if isinstance(x, Exchange)]
+            exchanges = self.model.get_agents(Exchange)
             if len(exchanges) > 0:
                 exchange = self.random.choice(exchanges)
 
@@ -139,24 +148,52 @@ class Entity(Agent):
                 exchange.buy(amount, buy_wallet)
 
         # See if the agent makes a transaction based on the temperature
-        if self.temperature < self.random.random():
+        if temperature_reached is None:
+            temperature_reached = self.temperature >= self.random.random()
+        if not temperature_reached:
             return
 
-        # Randomly select a habit to spend on
-        habit = self.random.choice([i for i, x in enumerate(self.habits) if x])
-        # Select a vendor for the habit
-        # TODO vendor favorism
-        merchants = [x for x in self.model.schedule.agents
-                     if isinstance(x, Merchant) and habit in x.get_habit_indices()]
+        if self.model.MERCHANT_MATCHING == 'habit':
+            # Randomly select a habit to spend on
+            habit = self.random.choice([i for i, x in enumerate(self.habits) if x])
+            # Select a vendor for the habit
+            merchants, cum_weights = self.model.habit_merchants(habit)
+        else:
+            # Select a vendor with habits similar to the agent
+            merchants, cum_weights = self.model.matched_merchants(self.habits)
         if len(merchants) == 0:
             return
 
-        transaction_amount = round(self.random.random() * self.get_total_wealth(), 5)
-        merchants_available = self.random.choices(merchants, [x.popularity for x in merchants])
+        fraction = self.random.random()
+        merchants_available = self.random.choices(merchants, cum_weights=cum_weights)
         if len(merchants_available) == 0:
             return
 
-        merchant: Merchant = merchants_available[0]
+        self.spend(merchants_available[0], fraction)
+
+    def simulate_transactions_with(self, decisions: 'StepDecisions', i: int):
+        """
+        simulate_transactions with the decisions drawn for the whole population
+        :param i: The index of the agent in the decisions
+        """
+        merchant = decisions.merchant(i)
+        if not decisions.buy[i] and merchant is None:
+            return
+        self.refresh_wallet_context()
+        if decisions.buy[i]:
+            exchange = decisions.exchange(i)
+            if exchange is not None:
+                buy_wallet = self.wallets[int(decisions.wallet[i] * len(self.wallets))]
+                exchange.buy(float(decisions.amount[i]), buy_wallet)
+
+        if merchant is not None:
+            self.spend(merchant, float(decisions.fraction[i]))
+
+    def spend(self, merchant: 'Merchant', fraction: float):
+        """
+        Trade a fraction of the wealth of the agent with a merchant
+        """
+        transaction_amount = round(fraction * self.get_total_wealth(), 5)
         # TODO select UTXO's
         # Select wallets where sum of balances > amount
         w = self.wallets.copy()
@@ -164,7 +201,8 @@ class Entity(Agent):
         transaction_wallets = []
         total = 0
         i = 0
-        while total < transaction_amount:
+        # Rounding can make the amount larger than the wealth, then the merchant refuses the trade
+        while total < transaction_amount and i < len(w):
             transaction_wallets.append(w[i])
             total += w[i].balance
             i += 1
@@ -181,7 +219,11 @@ class Entity(Agent):
             w.context = context
 
     def common(self):
-        # TODO Get blocks from the agents themselves
+        if self.model.network is not None:
+            # Only the chains announced by the peers of the agent are seen
+            self.adopt(self.model.network.longest_peer_chain(self))
+            return
+
         agents = self.model.schedule.agents
         cb = [a.blockchain for a in agents]
         # cb = self.model.candidate_blocks
@@ -193,16 +235,46 @@ class Entity(Agent):
             blockchain_options: List[Blockchain] = self.random.choices(cb, [len(x) for x in cb])
             # while not blockchain_options[0].block_exists(self.blockchain.get_tail()):
             #     blockchain_options: List[Blockchain] = self.random.choices(cb, [len(x) for x in cb])
-            if len(self.blockchain) < len(blockchain_options[0]):
-                self.blockchain = copy(blockchain_options[0])
+            self.adopt(blockchain_options[0])
+
+    def adopt(self, blockchain: Blockchain):
+        """
+        Follow blockchain if it is longer than the chain the agent follows
+        """
+        if len(self.blockchain) < len(blockchain):
+            self.blockchain = copy(blockchain)
 
     def step(self):
         self.common()
         self.substep()
 
+    def step_with(self, decisions: 'StepDecisions', i: int):
+        """
+        A step with the decisions drawn for the whole population, see population.BatchedActivation
+        :param i: The index of the agent in the decisions
+        """
+        self.adopt(decisions.chain(i))
+        self.substep_with(decisions, i)
+
     def substep(self):
         self.simulate_transactions()
 
+    def event_rate(self) -> float:
+        """
+        The expected number of times per step the agent is woken by events.EventActivation
+        """
+        return self.temperature
+
+    def wake(self):
+        """
+        Act on an event of events.EventActivation. The event is the temperature being reached
+        """
+        self.common()
+        self.simulate_transactions(temperature_reached=True)
+
+    def substep_with(self, decisions: 'StepDecisions', i: int):
+        self.simulate_transactions_with(decisions, i)
+
 
 class Miner(Entity):
     def __init__(self, uid: int, model: 'MoneyModel', h: List[bool], t: float, mining_power: float):
@@ -217,59 +289,23 @@ class Miner(Entity):
         self.mp = mining_power
         self.add_wallet()
 
-    def to_dict(self):
-        m_dict = super(Miner, self).to_dict()
+    def to_dict(self, include_blocks: bool = True):
+        m_dict = super(Miner, self).to_dict(include_blocks)
         m_dict['type'] = 'Miner'
         m_dict['mp'] = self.mp
         return m_dict
 
     def validate_transactions(self, txs: List[Transaction]) -> bool:
-        # Get all wallets
-        wallets: Dict[str, float] = {}
-        for agent in self.model.schedule.agents:
-            agent: Entity
-            t_wallets = agent.wallets
-            for w in t_wallets:
-                w.context = self.blockchain
-                wallets[w.key] = w.balance
-        # Update the balance of wallets according to the current chain
-
-        # for each transaction, see how the balance changes in order
-        for tx in txs:
-            for i in tx.inputs:
-                wallets[i['address']] -= i['amount']
-                if wallets[i['address']] < 0:
-                    return False
-            for o in tx.outputs:
-                wallets[o['address']] += o['amount']
-        #   if there is negative balance for a wallet at a particular transaction return False
-        # Otherwise return True
-        return True
+        # Apply the transactions in order on top of the state of the current chain. A transaction is invalid if it
+        # spends an output which is not unspent at that point, so no wallet can get a negative balance
+        validation = ValidationState(self.blockchain.state)
+        return all(validation.apply(tx) for tx in txs)
 
     def get_valid_tx_subset(self, txs: List[Transaction]) -> List[Transaction]:
-        wallets: Dict[str, List[float]] = {}
-        for agent in self.model.schedule.agents:
-            agent: Entity
-            t_wallets = agent.wallets
-            for w in t_wallets:
-                w.context = self.blockchain
-                wallets[w.key] = w.utxo
-        # Update the balance of wallets according to the current chain
-        valid_subset = []
-        for tx in txs:
-            tx_valid = True
-            for i in tx.inputs:
-                if i['amount'] in wallets[i['address']]:
-                    wallets[i['address']].remove(i['amount'])
-                else:
-                    tx_valid = False
-                    break
-            if not tx_valid:
-                continue
-            for o in tx.outputs:
-                wallets[o['address']].append(o['amount'])
-            valid_subset.append(tx)
-        return valid_subset
+        # Transactions are valid if they only spend outputs which are unspent on the current chain or created by an
+        # earlier transaction of the subset
+        validation = ValidationState(self.blockchain.state)
+        return [tx for tx in txs if validation.apply(tx)]
 
     def mine(self) -> Union[Block, None]:
         # TODO implement mining
@@ -278,11 +314,11 @@ class Miner(Entity):
 
         # register a Block to the model
         # Get all transactions
-        all_transactions = [x for x in self.model.pending_transactions if not self.blockchain.transaction_exists(x)]
+        all_transactions = self.blockchain.unconfirmed(self.model.mempool.transactions())
 
         self.random.shuffle(all_transactions)
-        # Pick 500 transactions
-        block_transactions = all_transactions[:500]
+        # Pick the maximum number of transactions in a block
+        block_transactions = all_transactions[:self.model.TRANSACTIONS_PER_BLOCK]
 
         block_transactions = self.get_valid_tx_subset(block_transactions)
         # TODO check that the transactions are valid i.e. the wallets are spending the amount that they have
@@ -290,8 +326,8 @@ class Miner(Entity):
             return None
 
         # add mining reward to the block
-        reward_transaction = Transaction([{'address': 'reward', 'amount': self.model.BLOCK_MINING_REWARD}],
-                                         [{'address': mine_wallet.key, 'amount': self.model.BLOCK_MINING_REWARD}],
+        reward_transaction = Transaction([TxInput('reward', self.model.BLOCK_MINING_REWARD)],
+                                         [TxOutput(mine_wallet.key, self.model.BLOCK_MINING_REWARD)],
                                          'reward')
 
         block_transactions.append(reward_transaction)
@@ -308,32 +344,54 @@ class Miner(Entity):
         # Select an amount to sell
         sell_amount = round(self.get_total_wealth() * self.random.random(), 4)
 
-        # Select a Exchange based on popularity
-        exchanges = [x for x in self.model.schedule.agents if isinstance(x, Exchange)]
-        if len(exchanges) == 0:
-            return
-
         # Randomly select exchanges based on their popularity
         # TODO exchange preferences based on agents can be implemented
-        exchange_to_sell: Exchange = self.random.choices(exchanges, [x.popularity for x in exchanges])[0]
+        exchange_to_sell: Exchange = self.model.choose_exchange()
+        if exchange_to_sell is None:
+            return
 
         change_wallet = Wallet(self.model, context=self.blockchain)
         if exchange_to_sell.sell(sell_amount, self.wallets, change_wallet):
             self.wallets.append(change_wallet)
 
+    def mine_block(self) -> Union[Block, None]:
+        """
+        Mine a block on the chain of the miner and add it to the chain
+        """
+        block = self.mine()
+        if block:
+            self.blockchain.add(block)
+            self.model.mempool.follow(self.model.block_tree, block)
+        return block
+
     def substep(self):
         blocks = []
         while self.random.random() < self.mp:
-            block = self.mine()
+            block = self.mine_block()
             if block:
                 blocks.append(block)
-                self.blockchain.add(block)
 
         # if len(blocks) > 0:
         #     self.model.candidate_blocks.append(self.blockchain)
 
         self.sell()
 
+    def event_rate(self) -> float:
+        # A step mines mp / (1 - mp) blocks and sells once on average
+        return self.mp / (1 - self.mp) + 1
+
+    def wake(self):
+        # Every event either sells or mines one block, in proportion to their rates
+        self.common()
+        if self.random.random() * self.event_rate() < 1:
+            self.sell()
+        else:
+            self.mine_block()
+
+    def substep_with(self, decisions: 'StepDecisions', i: int):
+        # Miners are few, so they keep making their own draws
+        self.substep()
+
 
 class Exchange(Entity):
     popularity: float
@@ -342,8 +400,8 @@ class Exchange(Entity):
         super(Exchange, self).__init__(uid, model, [], 0)
         self.popularity = popularity
 
-    def to_dict(self):
-        m_dict = super(Exchange, self).to_dict()
+    def to_dict(self, include_blocks: bool = True):
+        m_dict = super(Exchange, self).to_dict(include_blocks)
         m_dict['popularity'] = self.popularity
         m_dict['type'] = 'Exchange'
         return m_dict
@@ -358,10 +416,13 @@ class Exchange(Entity):
         self.wallets.append(change_wallet)
 
         transaction = self.tx_from_wallets(amount, self.wallets, wallet, change_wallet)
+        if transaction is None:
+            self.wallets.remove(change_wallet)
+            return False
         transaction.memo = "buying from exchange"
 
         # Add to pending transactions
-        self.model.pending_transactions.append(transaction)
+        self.model.mempool.add(transaction)
         return True
 
     def sell(self, amount: float, wallets: List[Wallet], change_wallet: Wallet):
@@ -379,15 +440,27 @@ class Exchange(Entity):
             deposit_wallet = self.random.choice(self.wallets)
 
         transactions = self.tx_from_wallets(amount, wallets, deposit_wallet, change_wallet, context=wallets[0].context)
+        if transactions is None:
+            return False
         transactions.memo = 'selling to exchange'
 
-        self.model.pending_transactions.append(transactions)
+        self.model.mempool.add(transactions)
         return True
 
     def substep(self):
         # TODO For now exchange does not make any profits or perform independent operations other than buying or selling
         pass
 
+    def substep_with(self, decisions: 'StepDecisions', i: int):
+        pass
+
+    def event_rate(self) -> float:
+        # Exchanges keep up with the chain every step, they need it to see the coins they can sell
+        return 1
+
+    def wake(self):
+        self.common()
+
 
 class Merchant(Entity):
     def __init__(self, uid, model, h, popularity):
@@ -395,8 +468,8 @@ class Merchant(Entity):
         # TODO Distribution for merchant items prices can be used
         self.popularity = popularity
 
-    def to_dict(self):
-        m_dict = super(Merchant, self).to_dict()
+    def to_dict(self, include_blocks: bool = True):
+        m_dict = super(Merchant, self).to_dict(include_blocks)
         m_dict['popularity'] = self.popularity
         m_dict['type'] = 'Merchant'
         return m_dict
@@ -422,12 +495,24 @@ class Merchant(Entity):
             deposit_wallet = self.random.choice(self.wallets)
 
         transactions = self.tx_from_wallets(amount, wallets, deposit_wallet, change_wallet, context=wallets[0].context)
+        if transactions is None:
+            return False
         transactions.memo = "trading with a merchant"
 
-        self.model.pending_transactions.append(transactions)
+        self.model.mempool.add(transactions)
 
         return True
 
     def substep(self):
         # TODO merchant doesn't do anything independently for now
         pass
+
+    def substep_with(self, decisions: 'StepDecisions', i: int):
+        pass
+
+    def event_rate(self) -> float:
+        # Merchants only catch up with the chain now and then, their chain is not used to trade
+        return self.model.MERCHANT_SYNC_RATE
+
+    def wake(self):
+        self.common()
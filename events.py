@@ -0,0 +1,61 @@
+"""
+A discrete event scheduler. Instead of stepping every agent every step, every agent is woken at random times with
+exponential waits between them, at the rate given by Entity.event_rate. The cost of a step depends on the number of
+events in it rather than on the number of agents.
+"""
+import heapq
+from typing import Dict, List, Tuple
+import typing
+from mesa.time import BaseScheduler
+
+if typing.TYPE_CHECKING:
+    from entity import Entity
+    from MoneyModel import MoneyModel
+
+
+class EventActivation(BaseScheduler):
+    """
+    Wakes agents from a queue of events ordered by time. A step runs the events up to the next whole time. The waits
+    are drawn from the random number generator of the model, and events at the same time run in the order they were
+    queued, so a run only depends on the seed.
+    """
+    queue: List[Tuple[float, int, int]]
+    by_id: Dict[int, 'Entity']
+
+    def __init__(self, model: 'MoneyModel'):
+        super().__init__(model)
+        self.queue = []
+        # The agents of the schedule by their unique id, to find the agent of an event
+        self.by_id = {}
+        self._queued = 0
+        self.events = 0
+
+    def add(self, agent: 'Entity'):
+        super().add(agent)
+        self.by_id[agent.unique_id] = agent
+        self._queue(agent, self.time)
+
+    def remove(self, agent: 'Entity'):
+        super().remove(agent)
+        del self.by_id[agent.unique_id]
+
+    def _queue(self, agent: 'Entity', now: float):
+        rate = agent.event_rate()
+        if rate <= 0:
+            return
+        heapq.heappush(self.queue, (now + self.model.random.expovariate(rate), self._queued, agent.unique_id))
+        self._queued += 1
+
+    def step(self):
+        end = self.time + 1
+        while self.queue and self.queue[0][0] < end:
+            time, _, unique_id = heapq.heappop(self.queue)
+            # Events of removed agents are dropped
+            agent = self.by_id.get(unique_id)
+            if agent is None:
+                continue
+            agent.wake()
+            self.events += 1
+            self._queue(agent, time)
+        self.steps += 1
+        self.time = end
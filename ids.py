@@ -0,0 +1,25 @@
+"""
+Identifiers of blocks, transactions and wallets. They are drawn from a seeded generator instead of the operating
+system, so that a simulation produces the same identifiers every time it is run with the same seed.
+"""
+import random
+import uuid
+from typing import Any, Hashable
+
+_random = random.Random()
+
+
+def seed(a: Hashable = None):
+    _random.seed(a)
+
+
+def new_id() -> str:
+    return str(uuid.UUID(int=_random.getrandbits(128), version=4))
+
+
+def getstate() -> Any:
+    return _random.getstate()
+
+
+def setstate(state: Any):
+    _random.setstate(state)
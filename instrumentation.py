@@ -0,0 +1,189 @@
+"""
+Timing of the phases of a model step. Instrumenting a model replaces the methods of the phases with wrappers which
+count the calls and the time spent in them, and restores them when it is stopped. Without instrumentation the
+methods are the plain ones, so there is no overhead.
+
+    instrumentation = model.instrument(profile_steps=[10])
+    for _ in range(20):
+        model.step()
+    print(instrumentation.format_summary())
+
+Times are inclusive: the time of simulate_transactions includes the time of the balances and coin selections it
+makes.
+"""
+import cProfile
+import functools
+import os
+import pstats
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import typing
+from entity import Entity, Miner
+from mempool import Mempool
+from wallet import Wallet
+
+if typing.TYPE_CHECKING:
+    from MoneyModel import MoneyModel
+
+# Phase name, class and attribute of the timed methods and properties
+PHASES: List[Tuple[str, type, str]] = [
+    ('common', Entity, 'common'),
+    ('simulate_transactions', Entity, 'simulate_transactions'),
+    ('simulate_transactions', Entity, 'simulate_transactions_with'),
+    ('mine', Miner, 'mine'),
+    ('get_valid_tx_subset', Miner, 'get_valid_tx_subset'),
+    ('validate_transactions', Miner, 'validate_transactions'),
+    ('balance', Wallet, 'balance'),
+    ('unspent', Wallet, 'unspent'),
+    ('utxo', Wallet, 'utxo'),
+    ('get_utxo', Wallet, 'get_utxo'),
+    ('mempool_expire', Mempool, 'expire')
+]
+
+_active: Optional['Instrumentation'] = None
+
+
+class Instrumentation:
+    """
+    Per step counts and times of the phases of a model. Instrumentation patches the classes of the phases, so only one
+    model in a process can be instrumented at a time.
+    """
+    records: List[Dict]
+    profiles: Dict[int, object]
+
+    def __init__(self, profile_steps: Iterable[int] = (), profiler: str = 'cprofile', profile_dir: str = None):
+        """
+        :param profile_steps: The steps to run under a profiler, counted from 0 at the start of the instrumentation
+        :param profiler: 'cprofile' for cProfile, or 'sampling' for the sampling profiler of pyinstrument
+        :param profile_dir: A directory to write the profiles to. Profiles are only kept in profiles if it is None
+        """
+        if profiler not in ('cprofile', 'sampling'):
+            raise ValueError('Unknown profiler: %s' % profiler)
+        self.profile_steps = set(profile_steps)
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.records = []
+        self.profiles = {}
+        self._phases = defaultdict(lambda: [0, 0.0])
+        self._originals = []
+
+    def start(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('Instrumentation: another model is already instrumented')
+        _active = self
+        for name, cls, attribute in PHASES:
+            original = cls.__dict__.get(attribute)
+            if original is None:
+                continue
+            self._originals.append((cls, attribute, original))
+            if isinstance(original, property):
+                setattr(cls, attribute, property(self._timed(name, original.fget)))
+            else:
+                setattr(cls, attribute, self._timed(name, original))
+
+    def stop(self):
+        global _active
+        for cls, attribute, original in reversed(self._originals):
+            setattr(cls, attribute, original)
+        self._originals = []
+        if _active is self:
+            _active = None
+
+    def _timed(self, name: str, func: Callable) -> Callable:
+        phases = self._phases
+        perf_counter = time.perf_counter
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phase = phases[name]
+                phase[0] += 1
+                phase[1] += perf_counter() - start
+        return wrapper
+
+    def step(self, model: 'MoneyModel', step: Callable[[], None]):
+        """
+        Run a step of the model and record its phases
+        """
+        n = len(self.records)
+        self._phases.clear()
+        start = time.perf_counter()
+        if n in self.profile_steps:
+            self._profile(n, step)
+        else:
+            step()
+        seconds = time.perf_counter() - start
+
+        cache = model.cache_stats[-1]
+        lookups = cache['hits'] + cache['misses']
+        self.records.append({
+            'step': n,
+            'seconds': seconds,
+            'phases': {name: {'calls': x[0], 'seconds': x[1]} for name, x in self._phases.items()},
+            'cache': dict(cache, hit_rate=cache['hits'] / lookups if lookups else None),
+            'mempool': model.mempool_stats[-1]
+        })
+
+    def _profile(self, n: int, step: Callable[[], None]):
+        if self.profiler == 'cprofile':
+            profile = cProfile.Profile()
+            profile.runcall(step)
+            self.profiles[n] = pstats.Stats(profile)
+            if self.profile_dir is not None:
+                profile.dump_stats(os.path.join(self.profile_dir, 'step_%d.prof' % n))
+        else:
+            # Optional dependency, only needed for sampling
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            try:
+                step()
+            finally:
+                profiler.stop()
+            self.profiles[n] = profiler
+            if self.profile_dir is not None:
+                with open(os.path.join(self.profile_dir, 'step_%d.txt' % n), 'w') as profile_file:
+                    profile_file.write(profiler.output_text())
+
+    def summary(self) -> Dict:
+        """
+        :return: The calls and times of every phase over all recorded steps, with the cache hit rate and the number of
+        expired transactions
+        """
+        phases = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        for record in self.records:
+            for name, phase in record['phases'].items():
+                phases[name]['calls'] += phase['calls']
+                phases[name]['seconds'] += phase['seconds']
+        total = sum([x['seconds'] for x in self.records])
+        hits = sum([x['cache']['hits'] for x in self.records])
+        misses = sum([x['cache']['misses'] for x in self.records])
+        for phase in phases.values():
+            phase['share'] = phase['seconds'] / total if total else 0
+            phase['per_call'] = phase['seconds'] / phase['calls'] if phase['calls'] else 0
+        return {
+            'steps': len(self.records),
+            'seconds': total,
+            'phases': dict(phases),
+            'cache_hit_rate': hits / (hits + misses) if hits + misses else None,
+            'cache_evictions': sum([x['cache']['evictions'] for x in self.records]),
+            'expired': sum([x['mempool']['expired'] for x in self.records])
+        }
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        lines = ['%d steps in %.3fs' % (summary['steps'], summary['seconds']),
+                 '%-22s %10s %10s %12s %7s' % ('phase', 'calls', 'time (s)', 'per call (us)', 'share')]
+        for name, phase in sorted(summary['phases'].items(), key=lambda x: -x[1]['seconds']):
+            lines.append('%-22s %10d %10.3f %12.1f %6.1f%%' % (
+                name, phase['calls'], phase['seconds'], phase['per_call'] * 1e6, phase['share'] * 100))
+        if summary['cache_hit_rate'] is not None:
+            lines.append('State cache hit rate %.1f%%, %d evictions' % (
+                summary['cache_hit_rate'] * 100, summary['cache_evictions']))
+        lines.append('Expired transactions: %d' % summary['expired'])
+        return '\n'.join(lines)
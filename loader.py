@@ -0,0 +1,180 @@
+"""
+Reading simulations in every format they have been written in, through one interface: the line delimited JSON of
+SimulationRecorder, a JSON list of steps, or a pickled list of steps. Every reader has a length, is indexed by step,
+iterates over the steps in order and reads a range of steps with steps(start, stop, every).
+
+The steps of a JSON list are indexed in place by scanning the file once for their offsets. A pickle can not be read in
+parts, so it is loaded once and its steps are written to a file of separately pickled steps. Both indexes are kept next
+to the simulation, and steps are then read from a memory map of the file, so only the steps read are loaded.
+"""
+import abc
+import json
+import mmap
+import os
+import pickle
+import re
+from typing import Dict, Iterator, List, Optional, Union
+from recorder import SimulationReader, index_path
+
+# Strings, which may contain brackets, and brackets
+_JSON_TOKENS = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]]')
+_OPEN = ord('[')
+_CLOSE = ord(']')
+
+
+class StepFile(abc.ABC):
+    """
+    Steps stored one after another in a file, read by their offsets in an index next to the simulation. The index is
+    built again when the size of the simulation changes or the file of the steps is missing.
+    """
+    format = ''
+    offsets: List[List[int]]
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map: Optional[mmap.mmap] = None
+        self.offsets = self._load_index()
+
+    @property
+    def data_path(self) -> str:
+        """
+        The file holding the steps
+        """
+        return self.path
+
+    def __enter__(self) -> 'StepFile':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[List[Dict], List[List[Dict]]]:
+        if isinstance(item, slice):
+            return list(self.steps(item.start, item.stop, item.step))
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('%s: step %d out of range' % (type(self).__name__, item))
+        return self.step(item)
+
+    def __iter__(self) -> Iterator[List[Dict]]:
+        return self.steps()
+
+    def step(self, n: int) -> List[Dict]:
+        """
+        :return: The agents of step n
+        """
+        if self._map is None:
+            with open(self.data_path, 'rb') as data_file:
+                self._map = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        start, end = self.offsets[n]
+        return self._decode(self._map[start:end])
+
+    def steps(self, start: int = 0, stop: int = None, every: int = 1) -> Iterator[List[Dict]]:
+        """
+        Read the steps from start up to stop, every every steps
+        """
+        for n in range(*slice(start, stop, every).indices(len(self))):
+            yield self.step(n)
+
+    @abc.abstractmethod
+    def _decode(self, data: bytes) -> List[Dict]:
+        """
+        :return: The agents of the step stored in data
+        """
+
+    @abc.abstractmethod
+    def _build_index(self) -> List[List[int]]:
+        """
+        :return: The start and end offsets of every step in data_path
+        """
+
+    def _load_index(self) -> List[List[int]]:
+        size = os.path.getsize(self.path)
+        if os.path.exists(index_path(self.path)) and os.path.exists(self.data_path):
+            with open(index_path(self.path)) as index_file:
+                index = json.load(index_file)
+            if index.get('format') == self.format and index.get('size') == size:
+                return index['steps']
+
+        steps = self._build_index()
+        with open(index_path(self.path), 'w') as index_file:
+            json.dump({'format': self.format, 'size': size, 'steps': steps}, index_file)
+        return steps
+
+
+class JsonSteps(StepFile):
+    """
+    A simulation written as a JSON list of steps, each a list of the agents as written by Entity.to_dict
+    """
+    format = 'json'
+
+    def _decode(self, data: bytes) -> List[Dict]:
+        return json.loads(data)
+
+    def _build_index(self) -> List[List[int]]:
+        steps = []
+        if os.path.getsize(self.path) == 0:
+            return steps
+        with open(self.path, 'rb') as sim_file, \
+                mmap.mmap(sim_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Steps are the lists inside the outer list. Brackets inside strings are skipped with the strings
+            depth = 0
+            start = 0
+            for match in _JSON_TOKENS.finditer(data):
+                token = data[match.start()]
+                if token == _OPEN:
+                    depth += 1
+                    if depth == 2:
+                        start = match.start()
+                elif token == _CLOSE:
+                    if depth == 2:
+                        steps.append([start, match.end()])
+                    depth -= 1
+        return steps
+
+
+class PickleSteps(StepFile):
+    """
+    A simulation written as a pickled list of steps. The steps are written to a file next to it, pickled one by one
+    """
+    format = 'pickle'
+
+    @property
+    def data_path(self) -> str:
+        return self.path + '.steps'
+
+    def _decode(self, data: bytes) -> List[Dict]:
+        return pickle.loads(data)
+
+    def _build_index(self) -> List[List[int]]:
+        steps = []
+        offset = 0
+        with open(self.path, 'rb') as sim_file:
+            simulation = pickle.load(sim_file)
+        with open(self.data_path, 'wb') as data_file:
+            for step in simulation:
+                data = pickle.dumps(step, pickle.HIGHEST_PROTOCOL)
+                data_file.write(data)
+                steps.append([offset, offset + len(data)])
+                offset += len(data)
+        return steps
+
+
+def open_simulation(path: str) -> Union[SimulationReader, StepFile]:
+    """
+    :param path: A .jsonl file written by SimulationRecorder, a .json list of steps or a pickled list of steps
+    """
+    if path.endswith('.jsonl'):
+        return SimulationReader(path)
+    elif path.endswith('.json'):
+        return JsonSteps(path)
+    return PickleSteps(path)
@@ -1,6 +1,7 @@
-from transaction import Transaction
+from transaction import Transaction, TxInput, TxOutput
 
 if __name__ == "__main__":
-    t = Transaction([{'0xa': 0.1}, {'0xb': 0.5}], [{'0xb': 0.1}, {'0xa': 0.5}])
+    t = Transaction([TxInput('0xa', 0.1, '0', 0), TxInput('0xb', 0.5, '0', 1)],
+                    [TxOutput('0xb', 0.1), TxOutput('0xa', 0.5)])
     print("test")
     pass
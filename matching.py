@@ -0,0 +1,83 @@
+"""
+Matching buyers with merchants by their habits. The habits of an agent are its embedding: a buyer is more likely to
+buy from a merchant whose habits are similar to its own. Similarities are cosine similarities of the habit vectors.
+"""
+from itertools import accumulate
+from typing import Dict, List, Sequence, Tuple
+import typing
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    from entity import Merchant
+
+
+def habit_matrix(habits: Sequence[Sequence[bool]], width: int) -> np.ndarray:
+    """
+    :return: The habit vectors as the rows of a matrix, scaled to unit length. Rows without habits stay zero
+    """
+    matrix = np.zeros((len(habits), width))
+    for i, h in enumerate(habits):
+        matrix[i, :len(h)] = h
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+class MerchantIndex:
+    """
+    The k merchants most similar to a habit vector, with cumulative weights for random.choices. A merchant is weighted
+    by its similarity times its popularity. Candidates are computed once for every distinct habit vector, so a
+    purchase does not look at every merchant. The index has to be built again when the merchants change.
+    """
+    def __init__(self, merchants: List['Merchant'], k: int, width: int):
+        """
+        :param merchants: The merchants to match with
+        :param k: The number of candidates for a habit vector
+        :param width: The length of the habit vectors
+        """
+        self.merchants = merchants
+        self.k = k
+        self.width = width
+        self.embeddings = habit_matrix([x.habits for x in merchants], width)
+        self.popularity = np.array([x.popularity for x in merchants], dtype=float)
+        self._candidates: Dict[bytes, Tuple[List['Merchant'], List[float]]] = {}
+
+    def key(self, habits: Sequence[bool]) -> bytes:
+        vector = np.zeros(self.width, dtype=bool)
+        vector[:len(habits)] = habits
+        return vector.tobytes()
+
+    def precompute(self, habits: Sequence[Sequence[bool]]):
+        """
+        Compute the candidates of many habit vectors with one product of matrices
+        """
+        keys = {}
+        for h in habits:
+            keys.setdefault(self.key(h), h)
+        keys = [(key, h) for key, h in keys.items() if key not in self._candidates]
+        if len(keys) == 0:
+            return
+        scores = habit_matrix([h for _, h in keys], self.width) @ self.embeddings.T
+        for (key, _), row in zip(keys, scores):
+            self._candidates[key] = self._top_k(row)
+
+    def candidates(self, habits: Sequence[bool]) -> Tuple[List['Merchant'], List[float]]:
+        """
+        :return: The most similar merchants, most similar first, and the cumulative sums of their weights
+        """
+        key = self.key(habits)
+        if key not in self._candidates:
+            self.precompute([habits])
+        return self._candidates[key]
+
+    def _top_k(self, scores: np.ndarray) -> Tuple[List['Merchant'], List[float]]:
+        if len(scores) > self.k:
+            top = np.argpartition(-scores, self.k - 1)[:self.k]
+        else:
+            top = np.arange(len(scores))
+        # Sort by similarity, and by position for equal similarities so that the order does not depend on the
+        # partition
+        top = top[np.lexsort((top, -scores[top]))]
+        weights = scores[top] * self.popularity[top]
+        top = top[weights > 0]
+        weights = weights[weights > 0]
+        return [self.merchants[i] for i in top], list(accumulate(weights.tolist()))
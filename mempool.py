@@ -0,0 +1,122 @@
+from typing import Dict, List, Iterator, Optional
+import typing
+from transaction import Transaction
+
+if typing.TYPE_CHECKING:
+    from block import Block
+    from blocktree import BlockTree
+
+EVICTION_POLICIES = ('oldest', 'reject')
+
+
+class Mempool:
+    """
+    Transactions waiting to be added to a block. Transactions are bucketed by the step they were added in, so that
+    expiring transactions only touches the expired buckets. Transactions confirmed on the chain with the most work are
+    removed, and added again when a block leaves that chain.
+    """
+    buckets: Dict[int, Dict[str, Transaction]]
+    tx_step: Dict[str, int]
+    tip: Optional['Block']
+
+    def __init__(self, expiry: int, max_size: int = None, eviction: str = 'oldest'):
+        """
+        :param expiry: The number of steps a transaction stays in the pool after the step it was added in
+        :param max_size: The maximum number of transactions in the pool. There is no limit if it is None
+        :param eviction: What happens when a transaction is added to a full pool. 'oldest' evicts the oldest
+        transaction and 'reject' does not add the new one
+        """
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError('Unknown eviction policy: %s' % eviction)
+        self.expiry = expiry
+        self.max_size = max_size
+        self.eviction = eviction
+        self.step = 0
+        # Buckets are created in order of steps, so iterating over them gives the transactions in order of arrival
+        self.buckets = {}
+        self.tx_step = {}
+        self.evicted = 0
+        # The tip of the chain with the most work, see follow
+        self.tip = None
+
+    def __len__(self):
+        return len(self.tx_step)
+
+    def __contains__(self, tx: Transaction) -> bool:
+        return tx.id in self.tx_step
+
+    def __iter__(self) -> Iterator[Transaction]:
+        for bucket in self.buckets.values():
+            yield from bucket.values()
+
+    def transactions(self) -> List[Transaction]:
+        return list(self)
+
+    def add(self, tx: Transaction) -> bool:
+        """
+        :return: Whether the transaction was added. Transactions which are already in the pool are not added again
+        """
+        if tx.id in self.tx_step:
+            return False
+        if self.max_size is not None and len(self) >= self.max_size:
+            if self.eviction == 'reject' or self.max_size == 0:
+                self.evicted += 1
+                return False
+            # The pool holds more than max_size transactions if it was lowered since they were added
+            while len(self) >= self.max_size:
+                oldest = next(iter(self.buckets[next(iter(self.buckets))]))
+                self.remove(oldest)
+                self.evicted += 1
+        self.buckets.setdefault(self.step, {})[tx.id] = tx
+        self.tx_step[tx.id] = self.step
+        return True
+
+    def remove(self, txid: str) -> bool:
+        step = self.tx_step.pop(txid, None)
+        if step is None:
+            return False
+        bucket = self.buckets[step]
+        del bucket[txid]
+        if not bucket:
+            del self.buckets[step]
+        return True
+
+    def follow(self, tree: 'BlockTree', block: 'Block'):
+        """
+        Move to the chain ending at block if it has more work than the chain of the pool. The transactions of the blocks
+        which leave the chain are added again, as if they were made in the current step, and the transactions of the
+        blocks which join it are removed
+        """
+        if self.tip is None:
+            disconnect, connect = [], tree.chain(block)
+        elif block.chain_work > self.tip.chain_work:
+            disconnect, connect = tree.path(self.tip, block)
+        else:
+            return
+        self.tip = block
+        for disconnected in disconnect:
+            for tx in disconnected.transactions:
+                # Block rewards only exist in their block
+                if all(i.txid is not None for i in tx.inputs):
+                    self.add(tx)
+        for connected in connect:
+            for tx in connected.transactions:
+                self.remove(tx.id)
+
+    def expire(self) -> int:
+        """
+        End the current step and remove the transactions which were added more than expiry steps ago
+        :return: The number of transactions removed
+        """
+        expired = 0
+        last_expired_step = self.step - self.expiry
+        while self.buckets:
+            step = next(iter(self.buckets))
+            if step > last_expired_step:
+                break
+            bucket = self.buckets.pop(step)
+            for txid in bucket:
+                del self.tx_step[txid]
+            expired += len(bucket)
+        self.step += 1
+        return expired
@@ -0,0 +1,121 @@
+"""
+The peer to peer network of the agents. Every agent only sees the chains of its peers, and a chain announced in one
+step reaches the peers of an agent in the next step, so new tips spread hop by hop. The graph is generated once with
+NetworkX and the peers of every agent are stored in compressed sparse row arrays.
+"""
+from copy import copy
+from random import Random
+from typing import List
+import typing
+import networkx as nx
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    from blockchain import Blockchain
+    from entity import Entity
+
+
+def make_graph(topology: str, n: int, degree: int, seed: int) -> nx.Graph:
+    """
+    :param topology: 'random_regular', 'small_world' or 'scale_free'
+    :param n: The number of nodes
+    :param degree: The number of peers of every node. It is the average number of peers for 'scale_free'
+    """
+    degree = max(min(degree, n - 1), 0)
+    if topology == 'random_regular':
+        # Every node has degree peers, which needs an even number of ends of edges
+        if n * degree % 2:
+            degree -= 1
+        return nx.random_regular_graph(degree, n, seed=seed)
+    elif topology == 'small_world':
+        # Every node is joined to its degree nearest neighbours on a ring, with 10% of the edges rewired
+        return nx.connected_watts_strogatz_graph(n, max(degree, 2), 0.1, seed=seed)
+    elif topology == 'scale_free':
+        # Every new node attaches to degree / 2 nodes, preferring nodes with many peers
+        return nx.barabasi_albert_graph(n, max(degree // 2, 1), seed=seed)
+    raise ValueError('Unknown topology: %s' % topology)
+
+
+class PeerNetwork:
+    """
+    The peers of the agents, indexed by the position of the agent in the schedule
+    """
+    agents: List['Entity']
+    chains: List['Blockchain']
+    indptr: np.ndarray
+    indices: np.ndarray
+    lengths: np.ndarray
+
+    def __init__(self, agents: List['Entity'], topology: str, degree: int, rng: Random):
+        """
+        :param agents: The agents of the model, in the order of the schedule
+        :param degree: The number of peers of every agent
+        :param rng: The random number generator of the model, which seeds the graph
+        """
+        self.topology = topology
+        self.degree = degree
+        self.graph = make_graph(topology, len(agents), degree, rng.getrandbits(32))
+        self.agents = list(agents)
+        self.index = {x.unique_id: i for i, x in enumerate(self.agents)}
+        self._build_arrays()
+        self.announce()
+
+    def _build_arrays(self):
+        peers = [sorted(self.graph.neighbors(i)) for i in range(len(self.agents))]
+        self.indptr = np.zeros(len(peers) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum([len(x) for x in peers])
+        self.indices = np.array([j for x in peers for j in x], dtype=np.int64)
+
+    def add(self, agent: 'Entity', rng: Random):
+        """
+        Connect a new agent to randomly chosen peers
+        """
+        i = len(self.agents)
+        self.graph.add_node(i)
+        for j in rng.sample(range(i), min(self.degree, i)):
+            self.graph.add_edge(i, j)
+        self.agents.append(agent)
+        self.index[agent.unique_id] = i
+        self._build_arrays()
+        self.chains.append(copy(agent.blockchain))
+        self.lengths = np.append(self.lengths, len(agent.blockchain))
+
+    def peers(self, i: int) -> np.ndarray:
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def announce(self):
+        """
+        Every agent announces the chain it follows at the start of a step. Chains seen during the step are the
+        announced ones, so a new tip travels one hop per step
+        """
+        self.chains = [copy(x.blockchain) for x in self.agents]
+        self.lengths = np.array([len(x) for x in self.chains], dtype=np.int64)
+
+    def longest_peer_chain(self, agent: 'Entity') -> 'Blockchain':
+        """
+        :return: The longest chain announced by the peers of the agent, or the chain of the agent if it has no peers
+        """
+        peers = self.peers(self.index[agent.unique_id])
+        if len(peers) == 0:
+            return agent.blockchain
+        return self.chains[peers[np.argmax(self.lengths[peers])]]
+
+    def longest_peers(self) -> np.ndarray:
+        """
+        :return: For every agent the peer which announced the longest chain, the first one of equally long chains.
+        Agents without peers get themselves
+        """
+        n = len(self.agents)
+        result = np.arange(n)
+        if len(self.indices) == 0:
+            return result
+        degrees = np.diff(self.indptr)
+        nodes = np.repeat(np.arange(n), degrees)
+        peer_lengths = self.lengths[self.indices]
+        connected = degrees > 0
+        longest = np.zeros(n, dtype=np.int64)
+        longest[connected] = np.maximum.reduceat(peer_lengths, self.indptr[:-1][connected])
+        positions = np.flatnonzero(peer_lengths == longest[nodes])
+        found, first = np.unique(nodes[positions], return_index=True)
+        result[found] = self.indices[positions[first]]
+        return result
@@ -0,0 +1,140 @@
+"""
+A scheduler for large populations. Instead of every agent making its own draws from the random number generator of
+the model, the decisions of a step are drawn for all agents at once with NumPy, from the habits and temperatures of
+the agents stored as arrays. Only the agents whose decisions lead to a transaction run any Python code beyond
+following a longer chain.
+"""
+from typing import List, Optional
+import typing
+import numpy as np
+from mesa.time import RandomActivation
+from entity import Entity, Exchange
+
+if typing.TYPE_CHECKING:
+    from blockchain import Blockchain
+    from entity import Merchant
+    from MoneyModel import MoneyModel
+
+
+class StepDecisions:
+    """
+    The draws of one step for every agent, indexed by the position of the agent in the population. They follow the
+    draws of Entity.simulate_transactions and Entity.common
+    """
+    def __init__(self, population: 'BatchedActivation', generator: np.random.Generator):
+        model = population.model
+        agents = population.population
+        n = len(agents)
+        self.agents = agents
+        self.exchanges = model.get_agents(Exchange)
+
+        # Entity.common: the longest chain announced by a peer, or without a network the chain of an agent picked by
+        # the length of its chain. Then the lengths are those at the start of the step, and the chain is read when
+        # the agent steps
+        self.network = model.network
+        if self.network is not None:
+            self.source = self.network.longest_peers()
+        else:
+            lengths = np.array([len(x.blockchain) for x in agents], dtype=float)
+            self.source = generator.choice(n, size=n, p=lengths / lengths.sum())
+
+        # Buying from an exchange
+        self.buy = generator.random(n) < 0.5
+        self.exchange_index = generator.integers(0, max(len(self.exchanges), 1), size=n)
+        self.wallet = generator.random(n)
+        self.amount = np.maximum(np.round(generator.normal(model.AVG_TRANSACTION, model.WEALTH_SD, size=n), 4), 0)
+
+        # Spending on a habit, if the temperature is reached
+        habit_counts = population.habits.sum(axis=1)
+        transact = (population.temperatures >= generator.random(n)) & (habit_counts > 0)
+        # The k-th habit of the agent, for k drawn uniformly below the number of its habits
+        k = np.floor(generator.random(n) * habit_counts)
+        self.habit = np.argmax(np.cumsum(population.habits, axis=1) > k[:, None], axis=1)
+        self.fraction = generator.random(n)
+        merchant_draw = generator.random(n)
+
+        # Agents pick from the merchants of a habit, or from the merchants matching their habits
+        if model.MERCHANT_MATCHING == 'habit':
+            self.group = self.habit
+            self._group_merchants = lambda g: model.habit_merchants(int(g))
+        else:
+            self.group = population.pattern_ids
+            self._group_merchants = lambda g: model.matched_merchants(population.patterns[g])
+
+        # random.choices picks by bisecting the cumulative weights
+        self.merchant_index = np.full(n, -1)
+        for group in np.unique(self.group[transact]):
+            merchants, cum_weights = self._group_merchants(group)
+            if len(merchants) == 0:
+                continue
+            selected = transact & (self.group == group)
+            index = np.searchsorted(cum_weights, merchant_draw[selected] * cum_weights[-1], side='right')
+            self.merchant_index[selected] = np.minimum(index, len(merchants) - 1)
+
+    def chain(self, i: int) -> 'Blockchain':
+        """
+        :return: The chain agent i compares its own with
+        """
+        if self.network is not None:
+            return self.network.chains[self.source[i]]
+        return self.agents[self.source[i]].blockchain
+
+    def exchange(self, i: int) -> Optional[Exchange]:
+        if len(self.exchanges) == 0:
+            return None
+        return self.exchanges[self.exchange_index[i]]
+
+    def merchant(self, i: int) -> Optional['Merchant']:
+        """
+        :return: The merchant agent i spends with in this step, if any
+        """
+        if self.merchant_index[i] < 0:
+            return None
+        merchants, _ = self._group_merchants(self.group[i])
+        return merchants[self.merchant_index[i]]
+
+
+class BatchedActivation(RandomActivation):
+    """
+    Activates each agent once per step in random order, like RandomActivation, with the decisions of the step drawn
+    for all agents at once. The generator of every step is seeded from the random number generator of the model.
+    """
+    population: List[Entity]
+    habits: np.ndarray
+    temperatures: np.ndarray
+    patterns: np.ndarray
+    pattern_ids: np.ndarray
+
+    def __init__(self, model: 'MoneyModel'):
+        super().__init__(model)
+        self._arrays_valid = False
+
+    def add(self, agent: Entity):
+        super().add(agent)
+        self._arrays_valid = False
+
+    def remove(self, agent: Entity):
+        super().remove(agent)
+        self._arrays_valid = False
+
+    def _build_arrays(self):
+        self.population = list(self.agents)
+        max_habits = max([len(x.habits) for x in self.population] + [0])
+        self.habits = np.zeros((len(self.population), max_habits), dtype=bool)
+        for i, agent in enumerate(self.population):
+            self.habits[i, :len(agent.habits)] = agent.habits
+        self.temperatures = np.array([x.temperature for x in self.population], dtype=float)
+        # Agents with the same habits share their merchant candidates
+        self.patterns, self.pattern_ids = np.unique(self.habits, axis=0, return_inverse=True)
+        self.pattern_ids = self.pattern_ids.reshape(-1)
+        self._arrays_valid = True
+
+    def step(self):
+        if not self._arrays_valid:
+            self._build_arrays()
+        generator = np.random.default_rng(self.model.random.getrandbits(64))
+        decisions = StepDecisions(self, generator)
+        for i in generator.permutation(len(self.population)):
+            self.population[i].step_with(decisions, i)
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,388 @@
+"""
+Streaming simulation output. A simulation is written as line delimited JSON while it runs, with one record per line:
+
+    {"type": "block", "hash": ..., "prev": ..., "height": ..., "transactions": [...]}
+    {"type": "step", "step": ..., "agents": [...]}
+    {"type": "delta", "step": ..., "agents": {id: changes}, "added": [...], "removed": [...]}
+
+Every block is written once, before the first step in which an agent follows a chain containing it. In the agents of a
+step, 'blockchain' only holds the hash and length of the chain the agent follows.
+
+A 'step' record is a keyframe holding every agent. Between keyframes a 'delta' record only holds the agents which
+changed since the previous step: their changed attributes, the wallets which changed and the wallets which were added.
+The byte offsets of the records are written to an index file next to the simulation, so that a step can be read by
+seeking to the keyframe before it and applying the deltas after it.
+"""
+import bisect
+import json
+import mmap
+import os
+from collections import ChainMap
+from collections.abc import Sequence
+from itertools import islice
+from typing import Dict, Iterator, List, Mapping, Set, Optional, Union
+import typing
+
+if typing.TYPE_CHECKING:
+    from block import Block
+    from MoneyModel import MoneyModel
+
+
+def index_path(path: str) -> str:
+    return path + '.idx'
+
+
+class SimulationRecorder:
+    written_blocks: Set[str]
+
+    def __init__(self, path: str, keyframe_interval: int = 50):
+        """
+        :param path: The file to write the simulation to
+        :param keyframe_interval: The number of steps between keyframes. Every step is a keyframe if it is 1
+        """
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, 'wb')
+        self.offset = 0
+        self.written_blocks = set()
+        self.steps = 0
+        self.previous_agents: Dict[int, Dict] = {}
+        # Offsets of the records of blocks and steps
+        self.index = {'keyframe_interval': keyframe_interval, 'steps': [], 'keyframes': [], 'blocks': {}}
+
+    def __enter__(self) -> 'SimulationRecorder':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        with open(index_path(self.path), 'w') as index_file:
+            json.dump(self.index, index_file)
+
+    def record(self, model: 'MoneyModel'):
+        """
+        Write the blocks which are new since the last step, followed by the state of the agents
+        """
+        agents = model.schedule.agents
+        for agent in agents:
+            self._write_chain(agent.blockchain.get_tail())
+        agent_dicts = [x.to_dict(include_blocks=False) for x in agents]
+
+        self.index['steps'].append(self.offset)
+        if self.steps % self.keyframe_interval == 0:
+            self.index['keyframes'].append(self.steps)
+            self._write({'type': 'step', 'step': self.steps, 'agents': agent_dicts})
+        else:
+            self._write(self._delta(agent_dicts))
+        self.previous_agents = {x['id']: x for x in agent_dicts}
+        self.steps += 1
+
+    def _delta(self, agent_dicts: List[Dict]) -> Dict:
+        changes = {}
+        added = []
+        for agent in agent_dicts:
+            previous = self.previous_agents.get(agent['id'])
+            if previous is None:
+                added.append(agent)
+                continue
+            agent_changes = agent_delta(previous, agent)
+            if agent_changes:
+                changes[str(agent['id'])] = agent_changes
+        current_ids = set([x['id'] for x in agent_dicts])
+        return {
+            'type': 'delta',
+            'step': self.steps,
+            'agents': changes,
+            'added': added,
+            'removed': [x for x in self.previous_agents if x not in current_ids]
+        }
+
+    def _write_chain(self, tip: 'Block'):
+        new_blocks = []
+        while tip is not None and tip.id not in self.written_blocks:
+            new_blocks.append(tip)
+            tip = tip.parent
+        for block in reversed(new_blocks):
+            record = {'type': 'block', 'height': block.height}
+            record.update(block.to_dict())
+            self.index['blocks'][block.id] = self.offset
+            self._write(record)
+            self.written_blocks.add(block.id)
+
+    def _write(self, record: Dict):
+        line = (json.dumps(record) + '\n').encode()
+        self.file.write(line)
+        self.offset += len(line)
+
+
+def agent_delta(previous: Dict, agent: Dict) -> Dict:
+    """
+    :return: The changes from the previous dict of an agent to the current one
+    """
+    changes = {}
+    for key, value in agent.items():
+        if key != 'wallets' and previous.get(key) != value:
+            changes[key] = value
+
+    # Agents only add wallets, so the changes are the wallets which changed and the new wallets
+    wallets = agent['wallets']
+    previous_wallets = previous['wallets']
+    if len(wallets) < len(previous_wallets) or \
+            any(x['hash'] != y['hash'] for x, y in zip(wallets, previous_wallets)):
+        changes['wallets'] = wallets
+    else:
+        changed = [[i, x] for i, (x, y) in enumerate(zip(wallets, previous_wallets)) if x != y]
+        added = wallets[len(previous_wallets):]
+        if changed or added:
+            changes['wallet_changes'] = {'changed': changed, 'added': added}
+    return changes
+
+
+def apply_agent_delta(previous: Dict, changes: Dict) -> Dict:
+    agent = dict(previous)
+    agent.update(changes)
+    wallet_changes = agent.pop('wallet_changes', None)
+    if wallet_changes is not None:
+        wallets = list(previous['wallets'])
+        for i, wallet in wallet_changes['changed']:
+            wallets[i] = wallet
+        wallets.extend(wallet_changes['added'])
+        agent['wallets'] = wallets
+    return agent
+
+
+def apply_delta(agents: List[Dict], delta: Dict) -> List[Dict]:
+    """
+    :param agents: The agents of the previous step. They are not modified
+    :param delta: A 'delta' record
+    :return: The agents of the step of the delta
+    """
+    removed = set(delta['removed'])
+    changes = delta['agents']
+    result = []
+    for agent in agents:
+        if agent['id'] in removed:
+            continue
+        agent_changes = changes.get(str(agent['id']))
+        result.append(apply_agent_delta(agent, agent_changes) if agent_changes else agent)
+    result.extend(delta['added'])
+    return result
+
+
+class BlockList(Sequence):
+    """
+    The blocks of a chain from genesis, as the first length blocks of a list shared with the chains it grew from. The
+    list is only ever appended to, so the blocks of a chain do not change when a longer chain extends the list.
+    """
+    def __init__(self, blocks: List[Dict], length: int = None):
+        self._blocks = blocks
+        self._length = len(blocks) if length is None else length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(item, slice):
+            return [self._blocks[i] for i in range(*item.indices(self._length))]
+        if item < 0:
+            item += self._length
+        if not 0 <= item < self._length:
+            raise IndexError('BlockList: block %d out of range' % item)
+        return self._blocks[item]
+
+    def __iter__(self) -> Iterator[Dict]:
+        return islice(self._blocks, self._length)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (list, BlockList)):
+            return NotImplemented
+        return len(self) == len(other) and all(x == y for x, y in zip(self, other))
+
+    def __repr__(self):
+        return 'BlockList(%d blocks)' % self._length
+
+    def extend(self, blocks: List[Dict]) -> 'BlockList':
+        """
+        :return: The chain followed by blocks. The list is only copied if another chain already extended it
+        """
+        if not blocks:
+            return self
+        if len(self._blocks) != self._length:
+            return BlockList(self._blocks[:self._length] + blocks)
+        self._blocks.extend(blocks)
+        return BlockList(self._blocks)
+
+
+class SimulationReader:
+    """
+    Reads a simulation written by SimulationRecorder. Iterating over the reader reads the steps in order, indexing it
+    reads any step by starting from the keyframe before it. Steps are returned as the agents of the step as written by
+    Entity.to_dict, with the blocks of their chains. Records are read from a memory map of the file, so only the
+    records of the steps and blocks read are loaded.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.blocks: Dict[str, Dict] = {}
+        self.index = self._load_index()
+        # The chains of the last step read, by the hash of their tip
+        self._chains: Dict[str, BlockList] = {}
+        self._map: Optional[mmap.mmap] = None
+
+    def __enter__(self) -> 'SimulationReader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return len(self.index['steps'])
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[List[Dict], List[List[Dict]]]:
+        if isinstance(item, slice):
+            return list(self.steps(item.start, item.stop, item.step))
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('SimulationReader: step %d out of range' % item)
+        return self.step(item)
+
+    def __iter__(self) -> Iterator[List[Dict]]:
+        agents = None
+        with open(self.path, 'rb') as sim_file:
+            for line in sim_file:
+                record = json.loads(line)
+                if record['type'] == 'block':
+                    self.blocks.setdefault(record['hash'], self._block_dict(record))
+                    continue
+                agents = self._agents(record, agents)
+                yield self._with_chains(agents)
+
+    def step(self, n: int) -> List[Dict]:
+        """
+        :return: The agents of step n
+        """
+        return self._with_chains(self.agents(n))
+
+    def steps(self, start: int = 0, stop: int = None, every: int = 1) -> Iterator[List[Dict]]:
+        """
+        Read the steps from start up to stop, every every steps. Deltas are applied forward from the last step read when
+        there is no keyframe in between, so only the records up to the steps read are loaded
+        """
+        agents = None
+        position = None
+        for n in range(*slice(start, stop, every).indices(len(self))):
+            keyframe = self._keyframe(n)
+            if position is None or not keyframe <= position <= n:
+                position, agents = keyframe, self._agents(self._record(self.index['steps'][keyframe]), None)
+            for i in range(position + 1, n + 1):
+                agents = self._agents(self._record(self.index['steps'][i]), agents)
+            position = n
+            yield self._with_chains(agents)
+
+    def agents(self, n: int) -> List[Dict]:
+        """
+        :return: The agents of step n, where 'blockchain' only holds the hash and length of the chain
+        """
+        agents = None
+        for i in range(self._keyframe(n), n + 1):
+            agents = self._agents(self._record(self.index['steps'][i]), agents)
+        return agents
+
+    def chain(self, tip: str, known: Mapping[str, BlockList] = None) -> BlockList:
+        """
+        :param known: Chains already read, by the hash of their tip. The blocks of a chain containing one of them are
+        only read back to it, and the chain shares its blocks with it
+        :return: The blocks from genesis up to the block with hash tip
+        """
+        known = known or {}
+        chain = []
+        block = self._block(tip)
+        while block is not None and block['hash'] not in known:
+            chain.append(block)
+            block = self._block(block['prev'])
+        chain.reverse()
+        if block is None:
+            return BlockList(chain)
+        return known[block['hash']].extend(chain)
+
+    def _block(self, block_hash: str) -> Optional[Dict]:
+        block = self.blocks.get(block_hash)
+        if block is None and block_hash in self.index['blocks']:
+            block = self._block_dict(self._record(self.index['blocks'][block_hash]))
+            self.blocks[block_hash] = block
+        return block
+
+    @staticmethod
+    def _block_dict(record: Dict) -> Dict:
+        # Blocks are returned as written by Block.to_dict, without the fields of the record
+        record.pop('type', None)
+        record.pop('height', None)
+        return record
+
+    def _keyframe(self, n: int) -> int:
+        # Keyframes are in order, so the last one up to n is found by bisection
+        return self.index['keyframes'][bisect.bisect_right(self.index['keyframes'], n) - 1]
+
+    def _record(self, offset: int) -> Dict:
+        if self._map is None:
+            with open(self.path, 'rb') as sim_file:
+                self._map = mmap.mmap(sim_file.fileno(), 0, access=mmap.ACCESS_READ)
+        end = self._map.find(b'\n', offset)
+        return json.loads(self._map[offset:end if end >= 0 else len(self._map)])
+
+    @staticmethod
+    def _agents(record: Dict, previous: Optional[List[Dict]]) -> List[Dict]:
+        if record['type'] == 'step':
+            return record['agents']
+        return apply_delta(previous, record)
+
+    def _with_chains(self, agents: List[Dict]) -> List[Dict]:
+        # Agents following the same tip share the list of blocks, and chains growing from the chains of the last step
+        # read only their new blocks and append them to the list of the chain they grew from
+        chains: Dict[str, BlockList] = {}
+        result = []
+        for agent in agents:
+            tip = agent['blockchain']['hash']
+            if tip not in chains:
+                chains[tip] = self.chain(tip, ChainMap(chains, self._chains))
+            agent = dict(agent)
+            agent['blockchain'] = {'blocks': chains[tip], 'hash': tip}
+            result.append(agent)
+        self._chains = chains
+        return result
+
+    def _load_index(self) -> Dict:
+        if os.path.exists(index_path(self.path)):
+            with open(index_path(self.path)) as index_file:
+                return json.load(index_file)
+
+        # The index is written when the recorder is closed. Without it the offsets are found by reading the file
+        index = {'steps': [], 'keyframes': [], 'blocks': {}}
+        offset = 0
+        with open(self.path, 'rb') as sim_file:
+            for line in sim_file:
+                record = json.loads(line)
+                if record['type'] == 'block':
+                    index['blocks'][record['hash']] = offset
+                else:
+                    if record['type'] == 'step':
+                        index['keyframes'].append(len(index['steps']))
+                    index['steps'].append(offset)
+                offset += len(line)
+        return index
+
+
+def read_steps(path: str) -> Iterator[List[Dict]]:
+    """
+    Read a recorded simulation one step at a time
+    :param path: A file written by SimulationRecorder
+    :return: The agents of every step as written by Entity.to_dict, with the blocks of their chains
+    """
+    return iter(SimulationReader(path))
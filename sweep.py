@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+"""
+Parameter sweeps of MoneyModel. Every combination of the parameters is run for a number of replicates on a pool of
+processes. The summary of every run is appended to <out>.jsonl as soon as it finishes, so that a sweep which was
+interrupted continues with the runs which are missing. The mean and standard deviation of the summaries over the
+replicates of every combination are written to <out>.csv.
+
+    python3 sweep.py --N 50 100 --miner 0.05 0.1 --replicates 4 --steps 50 --out sweep
+"""
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from typing import Dict, List, Iterator, Set, Tuple
+
+PARAMETERS = ['N', 'MINER_PERCENTAGE', 'SELLER_PERCENTAGE', 'EXCHANGE_PERCENTAGE', 'TRANSACTIONS_PER_BLOCK']
+METRICS = ['seconds', 'blocks', 'chain_length', 'tips', 'transactions', 'mempool', 'evicted', 'cache_hit_rate', 'gini']
+
+
+def run_seed(base_seed: int, params: Dict, replicate: int) -> int:
+    """
+    The seed of a run. It only depends on the parameters and the replicate, not on the order in which runs are made
+    """
+    key = json.dumps([base_seed, [params[x] for x in PARAMETERS], replicate])
+    return int(hashlib.sha256(key.encode()).hexdigest()[:16], 16)
+
+
+def make_runs(grid: Dict[str, List], replicates: int, steps: int, base_seed: int) -> List[Dict]:
+    """
+    :param grid: The values of every parameter in PARAMETERS
+    :return: A run for every combination of the parameters and every replicate
+    """
+    runs = []
+    for values in itertools.product(*[grid[x] for x in PARAMETERS]):
+        params = dict(zip(PARAMETERS, values))
+        if params['MINER_PERCENTAGE'] + params['SELLER_PERCENTAGE'] + params['EXCHANGE_PERCENTAGE'] > 1:
+            print('Skipping %s: the percentages add up to more than 1' % params)
+            continue
+        for replicate in range(replicates):
+            seed = run_seed(base_seed, params, replicate)
+            run = dict(params, replicate=replicate, seed=seed, steps=steps)
+            run['run_id'] = '%016x' % seed
+            runs.append(run)
+    return runs
+
+
+def gini(values: List[float]) -> float:
+    values = sorted(values)
+    total = sum(values)
+    if len(values) == 0 or total <= 0:
+        return 0
+    weighted = sum([(i + 1) * x for i, x in enumerate(values)])
+    return 2 * weighted / (len(values) * total) - (len(values) + 1) / len(values)
+
+
+def summarize(model) -> Dict:
+    """
+    :return: The metrics of a model after a run, measured on the chain most agents follow
+    """
+    agents = model.schedule.agents
+    tips = Counter([x.blockchain.hash for x in agents])
+    main_chain = next(x.blockchain for x in agents if x.blockchain.hash == tips.most_common(1)[0][0])
+    hits = sum([x['hits'] for x in model.cache_stats])
+    misses = sum([x['misses'] for x in model.cache_stats])
+    return {
+        'blocks': len(model.block_tree.blocks),
+        'chain_length': len(main_chain),
+        'tips': len(tips),
+        'transactions': sum([len(x) for x in main_chain.blocks]),
+        'mempool': len(model.mempool),
+        'evicted': model.mempool.evicted,
+        'cache_hit_rate': hits / (hits + misses) if hits + misses else 0,
+        'gini': gini([x.get_total_wealth(main_chain) for x in agents])
+    }
+
+
+def run_simulation(run: Dict) -> Dict:
+    """
+    Run the model for a run in the current process
+    :return: The run with its metrics, or with the error which stopped it
+    """
+    # Imported here so that the workers do not share any state of the parent
+    from MoneyModel import MoneyModel
+
+    result = dict(run)
+    start = time.perf_counter()
+    try:
+        # The agent types are drawn from the random module
+        random.seed(run['seed'])
+        model = MoneyModel(run['N'], MINER_PERCENTAGE=run['MINER_PERCENTAGE'],
+                           SELLER_PERCENTAGE=run['SELLER_PERCENTAGE'],
+                           EXCHANGE_PERCENTAGE=run['EXCHANGE_PERCENTAGE'], seed=run['seed'])
+        model.TRANSACTIONS_PER_BLOCK = run['TRANSACTIONS_PER_BLOCK']
+        for _ in range(run['steps']):
+            model.step()
+        result.update(summarize(model))
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def read_results(path: str) -> Iterator[Dict]:
+    if not os.path.exists(path):
+        return
+    with open(path) as results_file:
+        for line in results_file:
+            # A line can be cut off if the sweep was killed while writing it
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def completed_runs(path: str) -> Set[Tuple[str, int]]:
+    """
+    :return: The id and the number of steps of every run in the results file. The seed of a run does not depend on its
+    number of steps, so a run is only done if it was made for as many steps
+    """
+    return set([(x['run_id'], x['steps']) for x in read_results(path) if 'error' not in x])
+
+
+def sweep(runs: List[Dict], results_path: str, processes: int = None) -> int:
+    """
+    Make the runs which are not in the results file yet, appending their results as they finish
+    :param processes: The number of worker processes. All cores are used if it is None
+    :return: The number of runs made
+    """
+    done = completed_runs(results_path)
+    todo = [x for x in runs if (x['run_id'], x['steps']) not in done]
+    print('%d runs, %d already completed' % (len(runs), len(runs) - len(todo)))
+    if len(todo) == 0:
+        return 0
+
+    # Long runs go first so that the pool is not left waiting on them at the end
+    todo.sort(key=lambda x: x['N'] * x['steps'], reverse=True)
+    with Pool(processes) as pool, open(results_path, 'a') as results_file:
+        for i, result in enumerate(pool.imap_unordered(run_simulation, todo)):
+            results_file.write(json.dumps(result) + '\n')
+            results_file.flush()
+            status = result.get('error', '%.1fs' % result['seconds'])
+            print('[%d/%d] %s %s' % (i + 1, len(todo), result['run_id'], status))
+    return len(todo)
+
+
+def aggregate(results_path: str, table_path: str):
+    """
+    Write the mean and standard deviation of every metric over the replicates of every combination of parameters
+    """
+    groups = defaultdict(list)
+    for result in read_results(results_path):
+        if 'error' not in result:
+            groups[tuple(result[x] for x in PARAMETERS + ['steps'])].append(result)
+
+    with open(table_path, 'w', newline='') as table_file:
+        writer = csv.writer(table_file)
+        header = PARAMETERS + ['steps', 'runs']
+        for metric in METRICS:
+            header += [metric + '_mean', metric + '_sd']
+        writer.writerow(header)
+        for key in sorted(groups):
+            results = groups[key]
+            row = list(key) + [len(results)]
+            for metric in METRICS:
+                values = [x[metric] for x in results]
+                row += [statistics.mean(values), statistics.stdev(values) if len(values) > 1 else 0]
+            writer.writerow(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run MoneyModel over a grid of parameters')
+    parser.add_argument('--N', type=int, nargs='+', default=[100])
+    parser.add_argument('--miner', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--seller', type=float, nargs='+', default=[0.2])
+    parser.add_argument('--exchange', type=float, nargs='+', default=[0.02])
+    parser.add_argument('--tx-per-block', type=int, nargs='+', default=[500])
+    parser.add_argument('--replicates', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes, all cores by default')
+    parser.add_argument('--out', default='sweep')
+    args = parser.parse_args()
+
+    sweep_grid = {
+        'N': args.N,
+        'MINER_PERCENTAGE': args.miner,
+        'SELLER_PERCENTAGE': args.seller,
+        'EXCHANGE_PERCENTAGE': args.exchange,
+        'TRANSACTIONS_PER_BLOCK': args.tx_per_block
+    }
+    sweep_runs = make_runs(sweep_grid, args.replicates, args.steps, args.seed)
+    sweep(sweep_runs, args.out + '.jsonl', args.processes)
+    aggregate(args.out + '.jsonl', args.out + '.csv')
@@ -1,17 +1,54 @@
-from typing import List, Dict, TypeVar, Union
-from uuid import uuid4
+from typing import Dict, TypeVar, Union, Tuple, Optional, NamedTuple, Sequence
+from ids import new_id
+
+# An output is addressed by the id of the transaction that created it and its index in the outputs
+Outpoint = Tuple[str, int]
+
+
+class TxOutput(NamedTuple):
+    address: str
+    amount: float
+
+    def to_dict(self):
+        return {'address': self.address, 'amount': self.amount}
+
+
+class TxInput(NamedTuple):
+    """
+    An input spends the output at outpoint (txid, vout) and carries the address and amount of that output.
+    Block rewards have no outpoint.
+    """
+    address: str
+    amount: float
+    txid: Optional[str] = None
+    vout: Optional[int] = None
+
+    @property
+    def outpoint(self) -> Optional[Outpoint]:
+        if self.txid is None:
+            return None
+        return self.txid, self.vout
+
+    def to_dict(self):
+        if self.txid is None:
+            return {'address': self.address, 'amount': self.amount}
+        return {'address': self.address, 'amount': self.amount, 'txid': self.txid, 'vout': self.vout}
 
 
 class Transaction:
-    def __init__(self, inputs: List[Dict[str, Union[str, float]]], outputs: List[Dict[str, Union[str, float]]],
+    __slots__ = ('id', 'inputs', 'outputs', 'memo')
+
+    def __init__(self, inputs: Sequence[Union[TxInput, Dict[str, Union[str, float, int]]]],
+                 outputs: Sequence[Union[TxOutput, Dict[str, Union[str, float]]]],
                  memo: str = None):
         """
-        :param inputs: The inputs are a List of {address: amount}
-        :param outputs: The outputs are a List of {address: amount}
+        :param inputs: The inputs are a List of TxInput or {address, amount, txid, vout} where (txid, vout) is the
+        outpoint being spent. Block rewards have no outpoint
+        :param outputs: The outputs are a List of TxOutput or {address, amount}
         """
-        self.id = str(uuid4())
-        self.inputs = inputs
-        self.outputs = outputs
+        self.id = new_id()
+        self.inputs = tuple(x if isinstance(x, TxInput) else TxInput(**x) for x in inputs)
+        self.outputs = tuple(x if isinstance(x, TxOutput) else TxOutput(**x) for x in outputs)
         self.memo = memo
         is_fine = self._verify()
         if not is_fine:
@@ -22,14 +59,19 @@ class Transaction:
     def to_dict(self):
         return {
             'hash': self.id,
-            'inputs': self.inputs,
-            'outputs': self.outputs
+            'inputs': [x.to_dict() for x in self.inputs],
+            'outputs': [x.to_dict() for x in self.outputs]
         }
 
+    @staticmethod
+    def spend(address: str, outpoint: Outpoint, amount: float) -> TxInput:
+        """
+        Create an input which spends an outpoint
+        """
+        return TxInput(address, amount, outpoint[0], outpoint[1])
+
     def _verify(self) -> bool:
-        input_sum = sum([abs(x['amount']) for x in self.inputs])
-        output_sum = sum([abs(x['amount']) for x in self.outputs])
+        input_sum = sum([abs(x.amount) for x in self.inputs])
+        output_sum = sum([abs(x.amount) for x in self.outputs])
 
         return abs(input_sum - output_sum) < 0.0000001
-
-
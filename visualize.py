@@ -1,21 +1,82 @@
 #! /usr/bin/env python3
+import argparse
 import numpy as np
 import os
 import matplotlib as mpl
-import matplotlib.pyplot as plt
+from matplotlib.animation import PillowWriter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 import matplotlib.patches as mpatches
 from fa2 import ForceAtlas2
 from curved_edges import curved_edges
 from collections import defaultdict
 import json
+import itertools
 import networkx as nx
-import sys
 from tqdm import tqdm
-import pickle
-from matplotlib.axes._subplots import Axes
+from multiprocessing import Pool
+from analytics import ChainAnalytics, master_chain as get_master_chain
+from loader import open_simulation
+from matplotlib.axes import Axes
 
 forceatlas2 = ForceAtlas2(gravity=5)
+# The resolution of frames written as images and of frames of animations
+DPI = 500
+ANIMATION_DPI = 100
+# Layout iterations of the first keyframe, and of the later keyframes which start from the positions of the previous one
+INITIAL_LAYOUT_ITERATIONS = 100
+LAYOUT_ITERATIONS = 10
+
+
+class KeyframeLayout:
+    """
+    Positions of the agents across keyframes, in an array indexed by agent id. Every keyframe refines the positions of
+    the previous one with a few iterations of ForceAtlas2 instead of running the layout to convergence, and only agents
+    without a position are placed, next to their peers in the graph.
+    """
+    positions: np.ndarray
+    placed: np.ndarray
+
+    def __init__(self, iterations=LAYOUT_ITERATIONS, initial_iterations=INITIAL_LAYOUT_ITERATIONS, seed=0):
+        self.iterations = iterations
+        self.initial_iterations = initial_iterations
+        self.positions = np.zeros((0, 2))
+        self.placed = np.zeros(0, dtype=bool)
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, G):
+        """
+        :return: The positions of the nodes of G, by node
+        """
+        nodes = list(G.nodes())
+        ids = np.array(nodes, dtype=np.int64)
+        if len(ids) and ids.max() >= len(self.placed):
+            size = ids.max() + 1
+            self.positions = np.concatenate([self.positions, np.zeros((size - len(self.positions), 2))])
+            self.placed = np.concatenate([self.placed, np.zeros(size - len(self.placed), dtype=bool)])
+
+        if not self.placed.any():
+            pos = forceatlas2.forceatlas2_networkx_layout(G, pos=None, iterations=self.initial_iterations)
+        else:
+            self._place(G, ids[~self.placed[ids]])
+            pos = forceatlas2.forceatlas2_networkx_layout(G, pos={n: self.positions[n] for n in nodes},
+                                                          iterations=self.iterations)
+        self.positions[ids] = [pos[n] for n in nodes]
+        self.placed[ids] = True
+        return pos
+
+    def _place(self, G, new):
+        # New nodes start at the mean of their placed peers, or anywhere in the layout without them
+        placed = self.positions[self.placed]
+        low, high = placed.min(0), placed.max(0)
+        spread = max(np.max(high - low), 1) * 0.01
+        for n in new:
+            peers = [x for x in itertools.chain(G.predecessors(n), G.successors(n)) if self.placed[x]]
+            if peers:
+                self.positions[n] = self.positions[peers].mean(0) + self.rng.normal(0, spread, 2)
+            else:
+                self.positions[n] = self.rng.uniform(low, high)
 
 
 def get_wallet_balances(blockchain):
@@ -48,27 +109,65 @@ def get_user_user_transactions(blockchain, wallet_agent_map):
     return transactions
 
 
-def create_frame(G, pos, node_sizes, node_colors, legend_handles, step, stats, limits, filename):
-    # curves = curved_edges(G, pos)
-    # lc = LineCollection(curves, color='black', alpha=0.15, linewidths=1)
-    # pos = nx.layout.fruchterman_reingold_layout(G, iterations=200)
-    # pos = nx.layout.spring_layout(G)
-    ax: Axes = plt.gca()
-    # fig = plt.figure()
-    # fig.set_facecolor('black')
-    # ax.add_collection(lc)
-    ax.text(0, 0, 'Step: %d' % step, verticalalignment='bottom',
-            horizontalalignment='left', transform=ax.transAxes)
-    ax.text(0, 0, stats, verticalalignment='top', horizontalalignment='left', transform=ax.transAxes)
-    # ax.set_facecolor('black')
-    nodes = nx.draw_networkx_nodes(G, pos, node_size=node_sizes, node_color=node_colors, alpha=0.2)
-    nx.draw_networkx_edges(G, pos, edge_color='black', node_size=node_sizes, connectionstyle='arc3,rad=0.2', alpha=0.15, arrowsize=5)
-    plt.legend(handles=legend_handles)
-    plt.xlim(limits[0]-20, limits[1]+20)
-    plt.ylim(limits[2]-20, limits[3]+20)
-    # plt.show()
-    plt.savefig(os.path.join('plots', filename), dpi=500)
-    plt.clf()
+class FrameRenderer:
+    """
+    Draws frames on its own figure instead of the global pyplot one, so that every process can have one. The limits,
+    legend and texts are created once and only the nodes and edges are drawn again for every frame.
+    """
+    figure: Figure
+    ax: Axes
+
+    def __init__(self, node_colors, legend_handles, limits, dpi=DPI):
+        self.node_colors = node_colors
+        self.dpi = dpi
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        # curves = curved_edges(G, pos)
+        # lc = LineCollection(curves, color='black', alpha=0.15, linewidths=1)
+        # self.figure.set_facecolor('black')
+        # self.ax.set_facecolor('black')
+        self.ax.set_xlim(limits[0]-20, limits[1]+20)
+        self.ax.set_ylim(limits[2]-20, limits[3]+20)
+        self.ax.legend(handles=legend_handles)
+        self.step_text = self.ax.text(0, 0, '', verticalalignment='bottom',
+                                      horizontalalignment='left', transform=self.ax.transAxes)
+        self.stats_text = self.ax.text(0, 0, '', verticalalignment='top',
+                                       horizontalalignment='left', transform=self.ax.transAxes)
+        self._artists = []
+
+    def draw(self, G, pos, node_sizes, step, stats):
+        for artist in self._artists:
+            artist.remove()
+        self.step_text.set_text('Step: %d' % step)
+        self.stats_text.set_text(stats)
+        nodes = nx.draw_networkx_nodes(G, pos, ax=self.ax, node_size=node_sizes, node_color=self.node_colors,
+                                       alpha=0.2)
+        edges = nx.draw_networkx_edges(G, pos, ax=self.ax, edge_color='black', node_size=node_sizes,
+                                       connectionstyle='arc3,rad=0.2', alpha=0.15, arrowsize=5)
+        # Directed edges are drawn as a list of arrows
+        self._artists = [nodes] + (edges if isinstance(edges, list) else [edges])
+
+    def save(self, filename):
+        self.figure.savefig(filename, dpi=self.dpi)
+
+
+# The keyframes and renderer of a rendering process
+_worker_keyframes = None
+_worker_renderer = None
+
+
+def _init_worker(keyframe_data, node_colors, legend_handles, limits, dpi):
+    global _worker_keyframes, _worker_renderer
+    _worker_keyframes = keyframe_data
+    _worker_renderer = FrameRenderer(node_colors, legend_handles, limits, dpi)
+
+
+def _render_frame(frame):
+    keyframe, pos, filename = frame
+    kf = _worker_keyframes[keyframe]
+    _worker_renderer.draw(kf['G'], dict(enumerate(pos)), kf['node_sizes'], kf['step'], kf['stats'])
+    _worker_renderer.save(filename)
 
 
 def normalize_pos(pos, limits):
@@ -80,56 +179,144 @@ def normalize_pos(pos, limits):
     return dict(enumerate(normalized.tolist()))
 
 
-def create_visualization(keyframe_data, node_colors, legend_handles, num_intermediate=10):
-    # animation_keyframe_data.append({
-    #     'G': G,
-    #     'pos': pos,
-    #     'node_sizes': node_sizes,
-    #     'step': i,
-    #     'stats': chain_stats
-    # })
-    prev_pos = None
+def get_limits(keyframe_data):
     positions = [x['pos'] for x in keyframe_data]
     positions = np.array([x[1] for p in positions for x in p.items()])
     xmin = np.min(positions[:, 0])
     xmax = np.max(positions[:, 0])
     ymin = np.min(positions[:, 1])
     ymax = np.max(positions[:, 1])
-    limits = [xmin, xmax, ymin, ymax]
-
-    # for each keyframe
-    # Generate previous intermediate frames
-    # Create this frame
-    # save to folder
-    # convert frames to video
-    frame_num = 1
-    for i, kf in tqdm(enumerate(keyframe_data), total=len(keyframe_data)):
-        G = kf['G']
-        pos = kf['pos']
-        node_sizes = kf['node_sizes']
-        step = kf['step']
-        stats = kf['stats']
-        pos = normalize_pos(pos, limits)
-        if prev_pos:
-            # prev_pos = normalize_pos(prev_pos, limits)
-            # Generate intermediate frames
-            for j in range(num_intermediate):
-                ratio = j / num_intermediate
-                prev_vals = np.array([x[1] for x in prev_pos.items()])
-                pos_vals = np.array([x[1] for x in pos.items()])
-                intermediate_vals = (1-ratio) * prev_vals + ratio * pos_vals
-                intermediate_pos = dict(enumerate(intermediate_vals.tolist()))
-                create_frame(G, intermediate_pos, node_sizes, node_colors, legend_handles,
-                             step, stats, limits, '%04d.png' % frame_num)
-                frame_num += 1
-        prev_pos = pos
-        create_frame(G, pos, node_sizes, node_colors,
-                     legend_handles, step, stats, limits, '%04d.png' % frame_num)
-
-
-def visualize(sim_data):
+    return [xmin, xmax, ymin, ymax]
+
+
+def get_frames(keyframe_data, limits, num_intermediate=10):
+    """
+    :return: The index of the keyframe and an array of the positions of the nodes of every frame, with
+    num_intermediate frames moving the nodes from the positions of the previous keyframe before every keyframe
+    """
+    ratios = np.arange(num_intermediate) / num_intermediate
+    prev_vals = None
+    for i, kf in enumerate(keyframe_data):
+        pos_vals = np.array(list(normalize_pos(kf['pos'], limits).values()))
+        if prev_vals is not None:
+            # Generate intermediate frames. Agents added since the previous keyframe stay at their new positions
+            start = pos_vals.copy()
+            start[:len(prev_vals)] = prev_vals
+            intermediate_vals = start + ratios[:, None, None] * (pos_vals - start)
+            for vals in intermediate_vals:
+                yield i, vals
+        prev_vals = pos_vals
+        yield i, pos_vals
+
+
+def create_visualization(keyframe_data, node_colors, legend_handles, num_intermediate=10, processes=None,
+                         output=None, dpi=None, fps=10):
+    """
+    Render the frames of the keyframes
+    :param processes: The number of processes rendering frames to the plots directory, all processors if None
+    :param output: An animated file, such as a .gif, to write the frames to with the Pillow writer of matplotlib
+    instead of writing images to the plots directory. The frames of an animation are rendered in this process
+    :param dpi: The resolution of the frames, DPI for images and ANIMATION_DPI for animations if None
+    :param fps: The frames per second of the animation
+    """
+    limits = get_limits(keyframe_data)
+    frames = get_frames(keyframe_data, limits, num_intermediate)
+    total = len(keyframe_data) + max(len(keyframe_data) - 1, 0) * num_intermediate
+
+    if output is not None:
+        renderer = FrameRenderer(node_colors, legend_handles, limits, dpi or ANIMATION_DPI)
+        writer = PillowWriter(fps=fps)
+        with writer.saving(renderer.figure, output, renderer.dpi):
+            for i, pos in tqdm(frames, total=total):
+                kf = keyframe_data[i]
+                renderer.draw(kf['G'], dict(enumerate(pos)), kf['node_sizes'], kf['step'], kf['stats'])
+                writer.grab_frame()
+        return
+
+    # Frames are numbered from 1
+    tasks = ((i, pos, os.path.join('plots', '%04d.png' % (n + 1))) for n, (i, pos) in enumerate(frames))
+    init_args = (keyframe_data, node_colors, legend_handles, limits, dpi or DPI)
+    if processes == 1:
+        _init_worker(*init_args)
+        for task in tqdm(tasks, total=total):
+            _render_frame(task)
+        return
+    with Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+        for _ in tqdm(pool.imap_unordered(_render_frame, tasks, chunksize=4), total=total):
+            pass
+
+
+def build_keyframe(step, analytics: ChainAnalytics = None):
+    """
+    The graph of the agents of a step, with the transactions between them on the chain most agents follow as edges
+    :param step: The agents of a step as written by Entity.to_dict
+    :param analytics: The analytics of the previous step, which are moved to the chain of this step. Without it the
+    chain is read from genesis
+    :return: The graph, the sizes of the nodes and a description of the chains, or None if there are no edges
+    """
+    # NODE ATTRIBUTES
+    # Get the chains(plus no. of chains, length of chains, master chain)
+    active_chains = set([agent['blockchain']['hash'] for agent in step])
+    master_chain = get_master_chain(step)
+    # Get wallet -> node mapping
+    wallet_agent = {}
+    for agent in step:
+        for w in agent['wallets']:
+            wallet_agent[w['hash']] = agent['id']
+    # Get the value of wallets according to the longest chain
+    # Get node -> node transactions from wallet -> wallet transactions
+    if analytics is not None:
+        balances, node_node_transactions = analytics.update(master_chain['blocks'], wallet_agent)
+    else:
+        balances = get_wallet_balances(master_chain)
+        node_node_transactions = get_user_user_transactions(master_chain, wallet_agent)
+    # Get the value of nodes by accumulating the wallet wealth
+    agent_wealth = defaultdict(float)
+    for agent in step:
+        for w in agent['wallets']:
+            agent_wealth[agent['id']] += balances[w['hash']]
+
+    # EDGE ATTRIBUTES
+    # Assign edges based on node -> node transactions
+
+    # Create Network visualization
+    G = nx.DiGraph()
+    node_sizes = []
+    for a in step:
+        G.add_node(a['id'], weight=agent_wealth[a['id']])
+        node_sizes.append((50 + agent_wealth[a['id']]) * 0.1)
+    # node_sizes = [x*100 for x in node_sizes]
+
+    edge_weights = []
+    for n, w in node_node_transactions.items():
+        G.add_edge(n[0], n[1], weight=w)
+
+    if len(G.edges()) == 0:
+        return None
+
+    chain_stats = 'Chains: Master(%d blocks), Active(%d)' % (len(master_chain['blocks']),
+                                                             len(active_chains))
+    return {
+        'G': G,
+        'node_sizes': node_sizes,
+        'stats': chain_stats
+    }
+
+
+def visualize(sim_data, processes=None, output=None, dpi=None, layout_iterations=LAYOUT_ITERATIONS, start=1, stop=None,
+              every=1):
+    """
+    :param sim_data: A reader from loader.open_simulation, or a list of steps
+    :param processes: The number of processes rendering frames
+    :param output: An animated file to write instead of the images in the plots directory
+    :param dpi: The resolution of the frames
+    :param layout_iterations: The layout iterations refining the positions of the previous keyframe for every keyframe
+    :param start: The first step to visualize
+    :param stop: The step to stop before
+    :param every: Visualize every every steps
+    """
     print("simulation steps: %d" % len(sim_data))
-    prev_pos = None
+    layout = KeyframeLayout(layout_iterations)
     node_colors = []
     color_map = {
         'Entity': '#ff1111',
@@ -142,64 +329,22 @@ def visualize(sim_data):
         node_colors.append(color_map[a['type']])
 
     animation_keyframe_data = []
+    # Balances and transactions are carried from step to step, applying only the blocks new to the master chain
+    analytics = ChainAnalytics()
 
-    for i, step in enumerate(sim_data[1:]):
-        print('test')
-        # NODE ATTRIBUTES
-        # Get the chains(plus no. of chains, length of chains, master chain)
-        active_chains = {}
-        chain_counts = defaultdict(int)
-        for agent in step:
-            chain = agent['blockchain']
-            active_chains[chain['hash']] = {'chain': chain, 'length': len(chain['blocks'])}
-            chain_counts[chain['hash']] += 1
-        frequent_chains = sorted(chain_counts.items(), key=lambda x: x[1])
-        master_chain = active_chains[frequent_chains[-1][0]]['chain']
-        # Get the value of wallets according to the longest chain
-        balances = get_wallet_balances(master_chain)
-        # Get wallet -> node mapping
-        # Get the value of nodes by accumulating the wallet wealth
-        wallet_agent = {}
-        agent_wealth = defaultdict(float)
-        for agent in step:
-            wallets = agent['wallets']
-            for w in wallets:
-                wallet_agent[w['hash']] = agent['id']
-                agent_wealth[agent['id']] += balances[w['hash']]
-
-        # EDGE ATTRIBUTES
-        # Get wallet -> wallet transaction numbers
-        # Get node -> node transactions from wallet -> wallet transactions
-        node_node_transactions = get_user_user_transactions(master_chain, wallet_agent)
-        # Assign edges based on node -> node transactions
-
-        # Create Network visualization
-        G = nx.DiGraph()
-        node_sizes = []
-        for a in step:
-            G.add_node(a['id'], weight=agent_wealth[a['id']])
-            node_sizes.append((50 + agent_wealth[a['id']]) * 0.1)
-        # node_sizes = [x*100 for x in node_sizes]
-
-        edge_weights = []
-        for n, w in node_node_transactions.items():
-            G.add_edge(n[0], n[1], weight=w)
-
-        if len(G.edges()) == 0:
+    # Readers only load the steps visualized
+    step_numbers = range(*slice(start, stop, every).indices(len(sim_data)))
+    steps = sim_data.steps(start, stop, every) if hasattr(sim_data, 'steps') else sim_data[start:stop:every]
+    for i, step in zip(step_numbers, steps):
+        keyframe = build_keyframe(step, analytics)
+        if keyframe is None:
             continue
 
         # node_sizes = [v * 100 for v in nx.degree(G).values()]
-        pos = forceatlas2.forceatlas2_networkx_layout(G, pos=prev_pos)
-        prev_pos = pos
-        chain_stats = 'Chains: Master(%d blocks), Active(%d)' % (len(master_chain['blocks']),
-                                                                 len(active_chains.keys()))
-        animation_keyframe_data.append({
-            'G': G,
-            'pos': pos,
-            'node_sizes': node_sizes,
-            'step': i,
-            'stats': chain_stats
-        })
+        pos = layout.update(keyframe['G'])
+        keyframe['pos'] = pos
+        keyframe['step'] = i
+        animation_keyframe_data.append(keyframe)
 
         # curves = curved_edges(G, pos)
         # lc = LineCollection(curves, color='black', alpha=0.15, linewidths=1)
@@ -225,12 +370,25 @@ def visualize(sim_data):
         # # Create Legend
         # # Create Watermark
         # # Merge Everything
-    create_visualization(animation_keyframe_data, node_colors, legend_handles)
+    create_visualization(animation_keyframe_data, node_colors, legend_handles, processes=processes, output=output,
+                         dpi=dpi)
 
 
 if __name__ == "__main__":
-    simulation_path = sys.argv[1]
-    with open(simulation_path, 'rb') as sim_file:
-        simulation_data = pickle.load(sim_file)
+    parser = argparse.ArgumentParser(description='Render a recorded simulation')
+    parser.add_argument('simulation', help='A .jsonl file written by SimulationRecorder, a .json list of steps or a '
+                                           'pickled list of steps')
+    parser.add_argument('--processes', type=int, default=None, help='The number of rendering processes')
+    parser.add_argument('--output', default=None, help='An animated file, such as simulation.gif, to write instead of '
+                                                       'the images in the plots directory')
+    parser.add_argument('--dpi', type=int, default=None)
+    parser.add_argument('--layout-iterations', type=int, default=LAYOUT_ITERATIONS,
+                        help='The layout iterations of every keyframe after the first')
+    parser.add_argument('--start', type=int, default=1, help='The first step to visualize')
+    parser.add_argument('--stop', type=int, default=None, help='The step to stop before')
+    parser.add_argument('--every', type=int, default=1, help='Visualize every n-th step')
+    args = parser.parse_args()
 
-    visualize(simulation_data)
+    with open_simulation(args.simulation) as simulation_data:
+        visualize(simulation_data, processes=args.processes, output=args.output, dpi=args.dpi,
+                  layout_iterations=args.layout_iterations, start=args.start, stop=args.stop, every=args.every)
@@ -1,10 +1,11 @@
-import uuid
-from typing import List, Optional
+from ids import new_id
+from typing import List, Optional, Dict, Tuple
 import typing
+from coinselection import select_coins, TOLERANCE
 
 if typing.TYPE_CHECKING:
     from blockchain import Block, Blockchain
-    from transaction import Transaction
+    from transaction import Outpoint
 
 class Wallet:
     context: 'Blockchain'
@@ -16,68 +17,31 @@ class Wallet:
         if key:
             self.key = key
         else:
-            self.key = str(uuid.uuid4())
+            self.key = new_id()
         self.model = model
         # self.balance = balance
         # self.utxo = []
         self.context = context
-        self.utxo_cache = {}
-        self.balance_cache = {}
 
     @property
-    def utxo(self) -> List[float]:
+    def unspent(self) -> Dict['Outpoint', float]:
+        """
+        The unspent outputs of the wallet in its context as {outpoint: amount}
+        """
         if not self.context:
-            return []
-        if self.utxo_cache.get(self.context.hash) is not None:
-            return self.utxo_cache[self.context.hash].copy()
-        utxo = []
-        inputs = []
-        for block in self.context.blocks:
-            running_utxo = [y['amount'] for x in block.transactions for y in x.outputs if self.key == y['address']]
-            for x in running_utxo:
-                utxo.append(x)
-        # get inputs which have the wallet key and remove them from utxo
-        # TODO: Note: There is currently no id associated with a specific utxo, I am just randomly picking one which is
-        # the same
-        for block in self.context.blocks:
-            running_inputs = [y['amount'] for x in block.transactions for y in x.inputs if self.key == y['address']]
-            for x in running_inputs:
-                inputs.append(x)
+            return {}
+        return self.context.state.unspent(self.key).copy()
 
-        for i in inputs:
-            utxo.remove(i)
-        self.utxo_cache[self.context.hash] = utxo.copy()
-        return utxo
+    @property
+    def utxo(self) -> List[float]:
+        return list(self.unspent.values())
 
     @property
     def balance(self) -> float:
         # Base case: no context return zero
         if not self.context:
             return 0
-
-        if self.balance_cache.get(self.context.hash) is not None:
-            return self.balance_cache[self.context.hash]
-
-        # Get amount recieved and sent
-        c_balance = 0
-        amount_received = 0
-        amount_sent = 0
-        for block in self.context.blocks:
-            if self.balance_cache.get(block.id) is not None:
-                c_balance = self.balance_cache[block.id]
-                amount_received = 0
-                amount_sent = 0
-            else:
-                transactions: List['Transaction'] = block.transactions
-                amount_received += sum([y['amount'] for x in transactions for y in x.outputs if self.key == y['address']])
-                amount_sent += sum([y['amount'] for x in transactions for y in x.inputs if self.key == y['address']])
-                self.balance_cache[block.id] = c_balance + amount_received - amount_sent
-
-
-        # Return difference
-        diff = c_balance + amount_received - amount_sent
-        self.balance_cache[self.context.hash] = diff
-        return diff
+        return self.context.balance(self.key)
 
     def to_dict(self):
         # TODO
@@ -101,87 +65,23 @@ class Wallet:
         # self.utxo.append(amount)
         # return self.balance
 
-    def get_utxo(self, amount) -> (List[float], float):
-        if self.balance < amount:
+    def get_utxo(self, amount) -> (List[Tuple['Outpoint', float]], float):
+        """
+        Select unspent outputs of the wallet to spend with the coin selection strategy of the model
+        :param amount: The target amount
+        :return: The selected [(outpoint, amount)] and the change, or None if the wallet can not pay the amount
+        """
+        if self.balance < amount - TOLERANCE:
             return None
 
-        t_utxo = self.utxo.copy()
-        r_utxo = []
-        # https://github.com/bitcoin/bitcoin/blob/3015e0bca6bc2cb8beb747873fdf7b80e74d679f/src/wallet.cpp#L1276
-        # Coin Selection Algorithm
-        # If any of your UTXO² matches the Target¹ it will be used.
-        matching_amount_utxo = [x for x in t_utxo if x == amount]
-        if len(matching_amount_utxo) > 0:
-            r_utxo.append(amount)
-
-        # If the "sum of all your UTXO smaller than the Target" happens to match the Target, they will be used.
-        # (This is the case if you sweep a complete wallet.)
-        elif sum([x for x in t_utxo if x < amount]) == amount:
-            r_utxo = [x for x in t_utxo if x < amount]
-
-        # If the "sum of all your UTXO smaller than the Target" doesn't surpass the target,
-        # the smallest UTXO greater than your Target will be used.
-        # TODO Transaction Fee simulation
-        elif sum([x for x in t_utxo if x < amount]) < amount:
-            min_greater = min([x for x in t_utxo if x > amount])
-            r_utxo.append(min_greater)
-
-        # Else Bitcoin Core does 1000 rounds of randomly combining unspent transaction outputs until their
-        # sum is greater than or equal to the Target.
-        # If it happens to find an exact match, it stops early and uses that.
-        # https://github.com/bitcoin/bitcoin/blob/3015e0bca6bc2cb8beb747873fdf7b80e74d679f/src/wallet.cpp#L1129
-        else:
-            vfBest = [True] * len(t_utxo)
-            nBest = self.balance
-            nRep = 0
-            while nRep < 1000 and nBest != amount:
-                vIncluded = [False] * len(t_utxo)
-                nTotal = 0
-                fReachedTarget = False
-                nPass = 0
-                while nPass < 2 and not fReachedTarget:
-                    for i in range(len(t_utxo)):
-                        if nPass == 0 and self.model.random.choice([True, False]) or not vIncluded[i]:
-                            nTotal += t_utxo[i]
-                            vIncluded[i] = True
-                            if nTotal >= amount:
-                                fReachedTarget = True
-                                if nTotal<nBest:
-                                    nBest = nTotal
-                                    vfBest = vIncluded.copy()
-                                nTotal -= t_utxo[i]
-                                vIncluded[i] = False
-                    nPass+=1
-                nRep+=1
-            if nBest == amount:
-                new_utxo = []
-                for i, b in enumerate(vfBest):
-                    if b:
-                        new_utxo.append(t_utxo[i])
-                r_utxo = new_utxo
-            else:
-                # Otherwise it finally settles for the minimum of
-                #     the smallest UTXO greater than the Target
-                #     the smallest combination of UTXO it discovered in Step 4.
-                greater_utxo = [x for x in t_utxo if x > amount]
-                add_best_combo = False
-                if len(greater_utxo) > 0:
-                    min_greater = min(greater_utxo)
-                    if nBest < min_greater:
-                        add_best_combo=True
-                    else:
-                        r_utxo.append(min_greater)
-
-                else:
-                    add_best_combo = True
-
-                if add_best_combo:
-                    new_utxo = []
-                    for i, b in enumerate(vfBest):
-                        if b:
-                            r_utxo.append(t_utxo[i])
-
-        return r_utxo, sum(r_utxo) - amount
+        # Sorted by outpoint, as the order of the outputs of a state depends on the blocks undone to reach it
+        t_utxo = sorted(self.unspent.items())
+        selected = select_coins([x[1] for x in t_utxo], amount, self.model.random, self.model.COIN_SELECTION)
+        if not selected:
+            return None
+        r_utxo = [t_utxo[i] for i in selected]
+        # A selection can fall short of the amount by a rounding error
+        return r_utxo, max(sum([x[1] for x in r_utxo]) - amount, 0)
 
     def remove_balance(self, amount: float) -> bool:
         """